@@ -1,19 +1,232 @@
+import io
 import os
+import sys
+import re
 import math
 import json
+import queue
+import hashlib
+import shutil
+import tempfile
+import mmap
+import bisect
+import struct
+import sqlite3
+import time
+import random
+import asyncio
+import signal
 import logging
-from dataclasses import dataclass
-from datetime import datetime
-from typing import List, Tuple, Optional
+import logging.handlers
+import atexit
+import gzip
+import threading
+import gc
+import timeit
+import tracemalloc
+import argparse
+import functools
+import contextvars
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Set, Tuple, Optional
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # Opcional: cliente async nativo con pool de conexiones propio.
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    # Opcional: decode JSON más rápido para las páginas de Binance.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # POSIX: flock para que varios procesos compartan el archivo de log rotado.
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Opcional: analítica vectorizada del libro P2P (VWAP, percentiles, profundidad).
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # =========================
 # LOGGING (ES)
 # =========================
+# Identidad de la corrida: va como campo (%(run_id)s) en cada línea, no en el nombre del archivo.
+# El modo serve le da uno nuevo a cada ciclo; fuera de un ciclo se usa el del proceso.
+_run_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("run_id", default=None)
+_run_id_proceso = "-"
+_listener_logs: Optional[logging.handlers.QueueListener] = None
+
+
+def nuevo_run_id() -> str:
+    return f"{datetime.now():%Y%m%d_%H%M%S}-{os.urandom(3).hex()}"
+
+
+def run_id_actual() -> str:
+    return _run_id.get() or _run_id_proceso
+
+
+class _FiltroRunId(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.run_id = run_id_actual()
+        return True
+
+
+def kv(**campos: Any) -> Dict[str, Any]:
+    """
+    Campos clave/valor para un registro: logger.info("...", url, extra=kv(url=url, intento=2)).
+    Con LOG_FORMAT="json" van como claves propias; el formato texto muestra sólo el mensaje.
+    """
+    return {"campos": campos}
+
+
+class FormatterJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record, self.datefmt),
+            "nivel": record.levelname,
+            "run_id": getattr(record, "run_id", None),
+            "msg": record.getMessage(),
+        }
+        data.update(getattr(record, "campos", None) or {})
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandlerDiferido(logging.handlers.QueueHandler):
+    """
+    Encola el registro tal cual: el mensaje (msg % args) y el formato se arman en el
+    thread del QueueListener, no en el que loguea. Los args tienen que ser valores
+    que no cambien después (strings, números), como en todo este archivo.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _nombre_comprimido(nombre: str) -> str:
+    return f"{nombre}.gz"
+
+
+def _rotar_comprimiendo(origen: str, destino: str) -> None:
+    with open(origen, "rb") as f_in, gzip.open(destino, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(origen)
+
+
+class _ArchivoCompartido:
+    """
+    Para los handlers rotativos cuando varios procesos (serve + una corrida manual)
+    escriben el mismo archivo: cada emit toma un flock sobre <archivo>.lock, reabre el
+    archivo si otro proceso ya lo rotó (cambió el inodo) y recién ahí decide si rotar,
+    así se rota una sola vez y nadie sigue escribiendo en un archivo ya rotado.
+    Sin fcntl (Windows) se comporta como el handler base: un único proceso escribiendo.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._candado = open(f"{self.baseFilename}.lock", "a") if fcntl is not None else None
+        self._id_archivo = self._identidad()
+
+    def _identidad(self) -> Optional[Tuple[int, int]]:
+        if self.stream is None:
+            return None
+        st = os.fstat(self.stream.fileno())
+        return st.st_dev, st.st_ino
+
+    def _reabrir_si_rotado(self) -> bool:
+        try:
+            st = os.stat(self.baseFilename)
+            en_disco = (st.st_dev, st.st_ino)
+        except FileNotFoundError:
+            en_disco = None
+        if self.stream is not None and en_disco == self._id_archivo:
+            return False
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = self._open()
+        self._id_archivo = self._identidad()
+        return True
+
+    def _al_reabrir(self) -> None:
+        pass
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._candado is None:
+            super().emit(record)
+            return
+        fcntl.flock(self._candado, fcntl.LOCK_EX)
+        try:
+            if self._reabrir_si_rotado():
+                self._al_reabrir()
+            super().emit(record)
+        finally:
+            fcntl.flock(self._candado, fcntl.LOCK_UN)
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self._id_archivo = self._identidad()
+
+    def close(self) -> None:
+        super().close()
+        if self._candado is not None:
+            self._candado.close()
+            self._candado = None
+
+
+class _RotativoCompartido(_ArchivoCompartido, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class _DiarioCompartido(_ArchivoCompartido, logging.handlers.TimedRotatingFileHandler):
+    def _al_reabrir(self) -> None:
+        # Si otro proceso ya rotó a medianoche, acá no hay que volver a rotar.
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+
+def _handler_archivo(ruta: str) -> logging.Handler:
+    """
+    Un único archivo rotado por tamaño o a medianoche; los viejos (comprimidos) se borran
+    pasado LOG_BACKUP_COUNT. Lo pueden compartir varios procesos (ver _ArchivoCompartido).
+    Se usa para LOG_FILE y para METRICS_NDJSON.
+    """
+    if cfg.LOG_ROTATION == "midnight":
+        fh = _DiarioCompartido(ruta, when="midnight", backupCount=cfg.LOG_BACKUP_COUNT, encoding="utf-8")
+    else:
+        fh = _RotativoCompartido(
+            ruta, maxBytes=cfg.LOG_MAX_BYTES, backupCount=cfg.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    if cfg.LOG_COMPRESS:
+        fh.namer = _nombre_comprimido
+        fh.rotator = _rotar_comprimiendo
+    return fh
+
+
 def configurar_logger() -> logging.Logger:
-    os.makedirs("logs", exist_ok=True)
+    """
+    El logger sólo encola (QueueHandler); consola y archivo los escribe un QueueListener
+    en su propio thread, así el camino caliente no espera al disco ni arma strings.
+    Convención: mensajes con %-args (no f-strings) y campos con extra=kv(...), así un
+    nivel apagado corta antes de formatear nada.
+    """
+    global _run_id_proceso, _listener_logs
+    os.makedirs(os.path.dirname(cfg.LOG_FILE) or ".", exist_ok=True)
 
     nivel_str = os.getenv("LOG_LEVEL", "INFO").upper().strip()
     nivel = getattr(logging, nivel_str, logging.INFO)
@@ -21,28 +234,73 @@ def configurar_logger() -> logging.Logger:
     logger = logging.getLogger("cotizations-bot")
     logger.setLevel(nivel)
     logger.handlers.clear()
+    if _listener_logs is not None:
+        _listener_logs.stop()
 
     formato = logging.Formatter(
-        "%(asctime)s | %(levelname)s | %(message)s",
+        "%(asctime)s | %(levelname)s | %(run_id)s | %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S"
     )
 
     ch = logging.StreamHandler()
     ch.setLevel(nivel)
     ch.setFormatter(formato)
-    logger.addHandler(ch)
 
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    ruta_log = os.path.join("logs", f"run_{ts}.log")
-    fh = logging.FileHandler(ruta_log, encoding="utf-8")
+    fh = _handler_archivo(cfg.LOG_FILE)
     fh.setLevel(nivel)
-    fh.setFormatter(formato)
-    logger.addHandler(fh)
+    fh.setFormatter(FormatterJSON(datefmt="%Y-%m-%dT%H:%M:%S") if cfg.LOG_FORMAT == "json" else formato)
+
+    cola: queue.SimpleQueue = queue.SimpleQueue()
+    qh = _QueueHandlerDiferido(cola)
+    # El run_id se resuelve en el thread que loguea (el contexto no viaja por la cola).
+    qh.addFilter(_FiltroRunId())
+    logger.addHandler(qh)
+
+    _listener_logs = logging.handlers.QueueListener(cola, ch, fh, respect_handler_level=True)
+    _listener_logs.start()
 
-    logger.info(f"Logger inicializado. Nivel={nivel_str}. Archivo={ruta_log}")
+    _run_id_proceso = nuevo_run_id()
+    logger.info("Logger inicializado. Nivel=%s. Archivo=%s", nivel_str, cfg.LOG_FILE)
     return logger
 
 
+def cerrar_logs() -> None:
+    """Vacía la cola de logs y cierra los archivos (también corre solo al salir)."""
+    global _listener_logs, _archivo_metricas
+    if _listener_logs is not None:
+        _listener_logs.stop()
+        for handler in _listener_logs.handlers:
+            handler.close()
+        _listener_logs = None
+    with _lock_metricas:
+        if _archivo_metricas is not None:
+            _archivo_metricas.close()
+            _archivo_metricas = None
+
+
+atexit.register(cerrar_logs)
+
+
+_archivo_metricas: Optional[logging.Handler] = None
+_lock_metricas = threading.Lock()
+
+
+def escribir_metricas_ndjson(linea: str) -> None:
+    """Agrega una línea a METRICS_NDJSON, rotado y comprimido igual que LOG_FILE."""
+    global _archivo_metricas
+    with _lock_metricas:
+        ruta = os.path.abspath(cfg.METRICS_NDJSON)
+        if _archivo_metricas is not None and _archivo_metricas.baseFilename != ruta:
+            _archivo_metricas.close()
+            _archivo_metricas = None
+        if _archivo_metricas is None:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            _archivo_metricas = _handler_archivo(ruta)
+            _archivo_metricas.setFormatter(logging.Formatter("%(message)s"))
+        archivo = _archivo_metricas
+    archivo.handle(logging.makeLogRecord({"msg": linea, "levelno": logging.INFO, "levelname": "INFO"}))
+
+
 # =========================
 # CONFIG (SIN INPUTS)
 # =========================
@@ -59,6 +317,30 @@ class Config:
         "https://dolarhoy.com/cotizacion-dolar-blue",
         "https://dolarhoy.com/cotizaciondolarblue",
     )
+    # Hedged: si la principal no respondió en DOLARHOY_HEDGE_DELAY_SECS (o falló),
+    # se dispara el espejo; gana la primera que parsea. 0 = todas a la vez.
+    DOLARHOY_HEDGE: bool = True
+    DOLARHOY_HEDGE_DELAY_SECS: float = 1.5
+    # Streaming: se lee el HTML por chunks y se corta apenas aparecen Compra y Venta.
+    DOLARHOY_STREAMING: bool = True
+    # GET condicional (ETag / If-Modified-Since): ante un 304 se reusa el último Compra/Venta.
+    DOLARHOY_CONDITIONAL_GET: bool = True
+
+    # Estado persistente entre corridas (caches, etc.)
+    STATE_DIR: str = "estado"
+
+    # Cache de cotizaciones compartido entre corridas y procesos (SQLite).
+    # Dentro del TTL se reusa sin red; hasta TTL + SWR se devuelve lo viejo y se
+    # refresca en segundo plano. TTL 0 = sin cache para esa fuente.
+    CACHE_TTL_DOLARHOY_SECS: float = 60.0
+    CACHE_TTL_BINANCE_SECS: float = 30.0
+    CACHE_SWR_SECS: float = 300.0
+
+    # Historial binario append-only de cada ciclo (ver HistorialCotizaciones)
+    HISTORY_ENABLED: bool = True
+
+    # Modo daemon (`python test.py serve`): cron de 5 campos, en hora local.
+    SERVE_CRON: str = "* * * * *"
 
     BINANCE_P2P_API_URL: str = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
 
@@ -67,10 +349,89 @@ class Config:
     TRADE_TYPE: str = "SELL"
 
     ROWS: int = 20
-
-    HTTP_TIMEOUT_SECS: int = 25
+    # Profundidad del libro P2P: páginas de ROWS anuncios (1 = sólo la primera).
+    BINANCE_PAGES: int = 1
+    # Deja de paginar cuando los precios se alejan más de este % del mejor. 0 = sin corte.
+    BINANCE_DEPTH_MAX_DISTANCE_PCT: float = 3.0
+    # Monto (en unidades del asset, ~USD para USDT) para el precio efectivo de llenado.
+    BINANCE_FILL_AMOUNT_USD: float = 1000.0
+
+    # Modo lote (`python test.py lote`): se cotiza cada asset x fiat x tradeType
+    BATCH_ASSETS: Tuple[str, ...] = ("USDT", "USDC", "BTC")
+    BATCH_FIATS: Tuple[str, ...] = ("ARS", "BRL", "CLP", "UYU")
+    BATCH_TRADE_TYPES: Tuple[str, ...] = ("BUY", "SELL")
+
+    HTTP_TIMEOUT_SECS: int = 25  # lectura (y techo del timeout adaptativo)
+    HTTP_CONNECT_TIMEOUT_SECS: float = 5.0
     HTTP_RETRIES: int = 3
 
+    # Tope de tiempo para toda la corrida (todas las etapas y reintentos). 0 = sin tope.
+    RUN_DEADLINE_SECS: float = 20.0
+
+    # Cliente async: backoff exponencial con jitter y tope total por llamada
+    HTTP_BACKOFF_BASE_SECS: float = 0.5
+    HTTP_BACKOFF_MAX_SECS: float = 8.0
+    HTTP_DEADLINE_SECS: float = 60.0
+    HTTP_ASYNC_MAX_CONNECTIONS: int = 20
+    HTTP_MAX_CONCURRENCY_PER_HOST: int = 4
+    HTTP_CHUNK_BYTES: int = 16384
+
+    # Timeout de lectura adaptativo por endpoint (método + host + path): p99 de las latencias
+    # observadas x HTTP_TIMEOUT_P99_FACTOR, entre el piso y HTTP_TIMEOUT_SECS, y duplicado en
+    # cada reintento. El histograma se guarda en STATE_DIR; con menos de
+    # HTTP_LATENCY_MIN_SAMPLES muestras se usa HTTP_TIMEOUT_SECS. Al pasar HTTP_LATENCY_WINDOW
+    # muestras se cortan los conteos a la mitad, así pesa más lo reciente.
+    HTTP_ADAPTIVE_TIMEOUT: bool = True
+    HTTP_TIMEOUT_P99_FACTOR: float = 3.0
+    HTTP_TIMEOUT_FLOOR_SECS: float = 2.0
+    HTTP_LATENCY_MIN_SAMPLES: int = 20
+    HTTP_LATENCY_WINDOW: int = 1000
+
+    # Token bucket por host, compartido por las llamadas sync y async del proceso: hasta
+    # RATE_LIMIT_BURST requests de golpe y después RATE_LIMIT_PER_SEC por segundo. Un 429
+    # con Retry-After vacía el balde de ese host por ese tiempo.
+    # RATE_LIMIT_HOSTS pisa los valores por host: (host, burst, por_segundo).
+    RATE_LIMIT: bool = True
+    RATE_LIMIT_BURST: float = 10.0
+    RATE_LIMIT_PER_SEC: float = 5.0
+    RATE_LIMIT_HOSTS: Tuple[Tuple[str, float, float], ...] = (("dolarhoy.com", 4.0, 1.0),)
+
+    # Circuit breaker por host: tras CIRCUIT_FAILURE_THRESHOLD fallas seguidas el host queda
+    # "abierto" CIRCUIT_COOLDOWN_SECS (se duplica con cada sonda fallida, hasta el máximo) y
+    # las llamadas fallan al instante; vencido el plazo pasa una sola request de prueba.
+    # El estado se guarda en STATE_DIR para que lo respeten las corridas siguientes.
+    CIRCUIT_BREAKER: bool = True
+    CIRCUIT_FAILURE_THRESHOLD: int = 3
+    CIRCUIT_COOLDOWN_SECS: float = 60.0
+    CIRCUIT_COOLDOWN_MAX_SECS: float = 600.0
+
+    # Logs: un archivo rotado (por tamaño o "midnight"), comprimido, con LOG_BACKUP_COUNT de retención.
+    LOG_FILE: str = "logs/cotizations-bot.log"
+    LOG_ROTATION: str = "size"
+    LOG_MAX_BYTES: int = 5 * 1024 * 1024
+    LOG_BACKUP_COUNT: int = 14
+    LOG_COMPRESS: bool = True
+    # Formato del archivo: "texto" (como la consola) o "json" (una línea por registro, con los campos kv()).
+    LOG_FORMAT: str = "texto"
+
+    # Un registro NDJSON por corrida (spans de HTTP, parsers y publicación), junto al log y
+    # con su misma rotación, compresión y retención (LOG_*). "" = no se escribe.
+    METRICS_NDJSON: str = "logs/metricas.ndjson"
+    # Publicación al Google Form: toda fila pasa por un outbox en SQLite (STATE_DIR) y la
+    # manda un worker de fondo con su propia sesión. Lo que falla queda pendiente y se
+    # reenvía en bloque (FORM_REPLAY_CONCURRENCY envíos a la vez) en la próxima oportunidad.
+    FORM_RETRIES: int = 4
+    FORM_DRAIN_TIMEOUT_SECS: float = 30.0
+    FORM_REPLAY_CONCURRENCY: int = 8
+    FORM_REPLAY_BATCH: int = 200
+    # Una fila tomada por un proceso no la toma otro hasta que vence la reserva.
+    FORM_OUTBOX_LEASE_SECS: float = 60.0
+    FORM_OUTBOX_RETENTION_DAYS: float = 7.0
+
+    # Endpoint Prometheus (GET /metrics) en modo serve. 0 = apagado.
+    METRICS_PORT: int = 0
+    METRICS_HOST: str = "127.0.0.1"
+
 
 cfg = Config()
 
@@ -85,33 +446,1043 @@ FORM_FIELDS = {
 }
 
 
+# =========================
+# PRESUPUESTO DE TIEMPO (deadline global de la corrida)
+# =========================
+class PresupuestoAgotado(RuntimeError):
+    pass
+
+
+class Presupuesto:
+    """Deadline monotónico compartido por todas las llamadas HTTP de una corrida."""
+
+    def __init__(self, segundos: float):
+        self.segundos = segundos
+        self.limite = time.monotonic() + segundos
+
+    def restante(self) -> float:
+        return self.limite - time.monotonic()
+
+    def verificar(self, que: str) -> None:
+        if self.restante() <= 0:
+            raise PresupuestoAgotado(f"Presupuesto de {self.segundos:g}s de la corrida agotado antes de: {que}")
+
+
+_presupuesto_actual: contextvars.ContextVar[Optional[Presupuesto]] = contextvars.ContextVar("presupuesto", default=None)
+
+
+@contextmanager
+def presupuesto_de_ejecucion(segundos: float) -> Iterator[Optional[Presupuesto]]:
+    presupuesto = Presupuesto(segundos) if segundos and segundos > 0 else None
+    token = _presupuesto_actual.set(presupuesto)
+    try:
+        yield presupuesto
+    finally:
+        _presupuesto_actual.reset(token)
+
+
+def _timeouts_intento(que: str, lectura: Optional[float] = None) -> Tuple[float, float]:
+    """(connect, read) para un intento, recortados a lo que queda del presupuesto."""
+    connect, read = cfg.HTTP_CONNECT_TIMEOUT_SECS, lectura or cfg.HTTP_TIMEOUT_SECS
+    presupuesto = _presupuesto_actual.get()
+    if presupuesto is not None:
+        presupuesto.verificar(que)
+        restante = presupuesto.restante()
+        connect, read = min(connect, restante), min(read, restante)
+    return connect, read
+
+
+# =========================
+# MÉTRICAS DE CORRIDA (spans con reloj monotónico)
+# =========================
+class MetricasCorrida:
+    """Spans y totales de una corrida; al final se vuelcan como una línea NDJSON."""
+
+    def __init__(self, modo: str):
+        self.modo = modo
+        self.inicio = time.monotonic()
+        self.spans: List[Dict[str, Any]] = []
+        self.etapas: Dict[str, float] = {}
+        self.rc: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def agregar(self, nombre: str, inicio: float, fin: float, campos: Dict[str, Any]) -> None:
+        self.spans.append({
+            "nombre": nombre,
+            "inicio_ms": round((inicio - self.inicio) * 1e3, 2),
+            "dur_ms": round((fin - inicio) * 1e3, 2),
+            **campos,
+        })
+
+    def registro(self) -> Dict[str, Any]:
+        http = [sp for sp in self.spans if sp["nombre"] == "http"]
+        return {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "modo": self.modo,
+            "run_id": run_id_actual(),
+            "log": cfg.LOG_FILE,
+            "rc": self.rc,
+            "error": self.error,
+            "total_ms": round((time.monotonic() - self.inicio) * 1e3, 2),
+            "etapas_ms": {etapa: round(segundos * 1e3, 2) for etapa, segundos in self.etapas.items()},
+            "http": {
+                "intentos": len(http),
+                "reintentos": sum(1 for sp in http if sp.get("intento", 1) > 1),
+                "bytes": sum(sp.get("bytes", 0) for sp in http),
+            },
+            "spans": self.spans,
+        }
+
+
+_metricas_actuales: contextvars.ContextVar[Optional[MetricasCorrida]] = contextvars.ContextVar("metricas", default=None)
+_span_actual: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("span", default=None)
+
+
+@contextmanager
+def span(nombre: str, **campos: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Mide el bloque y lo agrega a las métricas de la corrida en curso (si hay).
+    El dict que se entrega se puede completar adentro (status, bytes, ttfb_ms...).
+    """
+    metricas = _metricas_actuales.get()
+    token = _span_actual.set(campos)
+    inicio = time.monotonic()
+    try:
+        yield campos
+    except BaseException as e:
+        campos["error"] = type(e).__name__
+        raise
+    finally:
+        _span_actual.reset(token)
+        fin = time.monotonic()
+        _observar_span(nombre, fin - inicio, campos)
+        if metricas is not None:
+            metricas.agregar(nombre, inicio, fin, campos)
+
+
+def _marcar_span(**campos: Any) -> None:
+    """Completa el span en curso desde código que no lo tiene a mano (p. ej. el cliente HTTP)."""
+    actual = _span_actual.get()
+    if actual is not None:
+        actual.update(campos)
+
+
+@contextmanager
+def metricas_de_corrida(logger: logging.Logger, modo: str) -> Iterator[MetricasCorrida]:
+    metricas = MetricasCorrida(modo)
+    token = _metricas_actuales.set(metricas)
+    try:
+        yield metricas
+    except BaseException as e:
+        metricas.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _metricas_actuales.reset(token)
+        CICLOS.incrementar(modo=modo, rc="error" if metricas.error else str(metricas.rc))
+        CICLO_DURACION.observar(time.monotonic() - metricas.inicio, modo=modo)
+        if cfg.METRICS_NDJSON:
+            try:
+                escribir_metricas_ndjson(json.dumps(metricas.registro(), ensure_ascii=False))
+            except OSError as e:
+                logger.warning("No se pudieron escribir las métricas en %s: %s", cfg.METRICS_NDJSON, e)
+
+
+def _medir_respuesta(campos: Dict[str, Any], r: Any, extractor: Any = None) -> None:
+    """status, TTFB y bytes de body recibidos de una respuesta (requests o httpx)."""
+    campos["status"] = r.status_code
+    # requests: elapsed = hasta tener los headers. En httpx el TTFB lo marca la traza del cliente.
+    if "ttfb_ms" not in campos and isinstance(r, requests.Response):
+        campos["ttfb_ms"] = round(r.elapsed.total_seconds() * 1e3, 2)
+    if extractor is not None:
+        campos["bytes"] = getattr(extractor, "bytes_leidos", 0)
+    elif r.status_code < 400:
+        campos["bytes"] = len(r.content)
+
+
+# =========================
+# MÉTRICAS PROMETHEUS (pre-agregadas; se exponen en modo serve)
+# =========================
+_BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
+
+
+def _numero_prometheus(valor: float) -> str:
+    return "+Inf" if valor == math.inf else repr(float(valor))
+
+
+def _etiquetas_prometheus(etiquetas: Tuple[Tuple[str, str], ...]) -> str:
+    if not etiquetas:
+        return ""
+    pares = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in etiquetas
+    )
+    return "{" + pares + "}"
+
+
+class MetricaPrometheus:
+    """
+    Una familia de series (counter, gauge o histogram) acumulada en memoria: observar
+    cuesta un bisect y un lock, y el scrape sólo formatea lo que ya está sumado.
+    Serie de histograma: [cuenta por bucket..., +Inf, suma, cantidad].
+    """
+
+    def __init__(self, nombre: str, tipo: str, ayuda: str, buckets: Optional[Tuple[float, ...]] = None):
+        self.nombre = nombre
+        self.tipo = tipo
+        self.ayuda = ayuda
+        self.buckets = buckets
+        self._series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def _serie(self, etiquetas: Dict[str, str]) -> List[float]:
+        clave = tuple(sorted(etiquetas.items()))
+        serie = self._series.get(clave)
+        if serie is None:
+            serie = self._series[clave] = [0.0] * (len(self.buckets) + 3 if self.buckets else 1)
+        return serie
+
+    def incrementar(self, valor: float = 1.0, **etiquetas: str) -> None:
+        with self._lock:
+            self._serie(etiquetas)[0] += valor
+
+    def fijar(self, valor: float, **etiquetas: str) -> None:
+        with self._lock:
+            self._serie(etiquetas)[0] = valor
+
+    def observar(self, valor: float, **etiquetas: str) -> None:
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._serie(etiquetas)
+            serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def exponer(self) -> List[str]:
+        with self._lock:
+            series = [(clave, list(serie)) for clave, serie in self._series.items()]
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        for clave, serie in series:
+            if not self.buckets:
+                lineas.append(f"{self.nombre}{_etiquetas_prometheus(clave)} {_numero_prometheus(serie[0])}")
+                continue
+            acumulado = 0.0
+            for limite, cuenta in zip(self.buckets + (math.inf,), serie):
+                acumulado += cuenta
+                le = clave + (("le", _numero_prometheus(limite)),)
+                lineas.append(f"{self.nombre}_bucket{_etiquetas_prometheus(le)} {_numero_prometheus(acumulado)}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas_prometheus(clave)} {_numero_prometheus(serie[-2])}")
+            lineas.append(f"{self.nombre}_count{_etiquetas_prometheus(clave)} {_numero_prometheus(serie[-1])}")
+        return lineas
+
+
+class RegistroPrometheus:
+    def __init__(self):
+        self._metricas: Dict[str, MetricaPrometheus] = {}
+
+    def metrica(self, nombre: str, tipo: str, ayuda: str, buckets: Optional[Tuple[float, ...]] = None) -> MetricaPrometheus:
+        if nombre not in self._metricas:
+            self._metricas[nombre] = MetricaPrometheus(nombre, tipo, ayuda, buckets)
+        return self._metricas[nombre]
+
+    def exponer(self) -> str:
+        return "\n".join(linea for m in self._metricas.values() for linea in m.exponer()) + "\n"
+
+
+PROMETHEUS = RegistroPrometheus()
+HTTP_DURACION = PROMETHEUS.metrica("cotibot_http_request_seconds", "histogram", "Duración de cada intento HTTP.", _BUCKETS_SEGUNDOS)
+HTTP_TTFB = PROMETHEUS.metrica("cotibot_http_ttfb_seconds", "histogram", "Tiempo hasta el primer byte (headers).", _BUCKETS_SEGUNDOS)
+HTTP_REINTENTOS = PROMETHEUS.metrica("cotibot_http_retries_total", "counter", "Intentos HTTP que fueron reintento.")
+HTTP_BYTES = PROMETHEUS.metrica("cotibot_http_received_bytes_total", "counter", "Bytes de body recibidos.")
+PARSE_DURACION = PROMETHEUS.metrica("cotibot_parse_seconds", "histogram", "Duración de los parsers.", _BUCKETS_SEGUNDOS)
+PUBLICACIONES = PROMETHEUS.metrica("cotibot_form_publish_total", "counter", "Publicaciones al Google Form por resultado.")
+PUBLICACION_DURACION = PROMETHEUS.metrica("cotibot_form_publish_seconds", "histogram", "Duración del POST al Google Form.", _BUCKETS_SEGUNDOS)
+CACHE_CONSULTAS = PROMETHEUS.metrica("cotibot_cache_requests_total", "counter", "Consultas a los caches por resultado (hit/stale/miss).")
+CICLOS = PROMETHEUS.metrica("cotibot_runs_total", "counter", "Corridas por modo y exit code.")
+CICLO_DURACION = PROMETHEUS.metrica("cotibot_run_seconds", "histogram", "Duración de cada corrida.", _BUCKETS_SEGUNDOS)
+COTIZACION = PROMETHEUS.metrica("cotibot_quote", "gauge", "Últimos valores publicados (cotizacion_final, binance_low, blue_compra, blue_venta).")
+OUTBOX_ENVIOS = PROMETHEUS.metrica("cotibot_outbox_sends_total", "counter", "Envíos desde el outbox del Google Form por resultado.")
+OUTBOX_PENDIENTES = PROMETHEUS.metrica("cotibot_outbox_pending", "gauge", "Filas del outbox sin publicar.")
+LIMITE_ESPERA = PROMETHEUS.metrica("cotibot_ratelimit_wait_seconds", "histogram", "Espera en el token bucket antes de cada intento HTTP.", _BUCKETS_SEGUNDOS)
+HTTP_TIMEOUT = PROMETHEUS.metrica("cotibot_http_timeout_seconds", "gauge", "Timeout de lectura adaptativo vigente por endpoint.")
+CIRCUITO_ESTADO = PROMETHEUS.metrica("cotibot_circuit_state", "gauge", "Estado del circuit breaker por host (0 cerrado, 1 semiabierto, 2 abierto).")
+CIRCUITO_RECHAZOS = PROMETHEUS.metrica("cotibot_circuit_rejections_total", "counter", "Llamadas cortadas por circuito abierto.")
+ULTIMA_CORRIDA_OK = PROMETHEUS.metrica("cotibot_last_success_timestamp_seconds", "gauge", "Epoch de la última corrida OK.")
+
+
+def _observar_span(nombre: str, segundos: float, campos: Dict[str, Any]) -> None:
+    if nombre == "http":
+        host = urlsplit(campos["url"]).netloc
+        HTTP_DURACION.observar(segundos, host=host, status=str(campos.get("status", "error")))
+        if "ttfb_ms" in campos:
+            HTTP_TTFB.observar(campos["ttfb_ms"] / 1e3, host=host)
+        if campos.get("intento", 1) > 1:
+            HTTP_REINTENTOS.incrementar(host=host)
+        if campos.get("bytes"):
+            HTTP_BYTES.incrementar(campos["bytes"], host=host)
+    elif nombre.startswith("parse_"):
+        PARSE_DURACION.observar(segundos, parser=nombre[len("parse_"):])
+    elif nombre == "publicar_form":
+        PUBLICACION_DURACION.observar(segundos)
+        ok = campos.get("status") == 200 and "error" not in campos
+        PUBLICACIONES.incrementar(resultado="ok" if ok else "error")
+
+
+class _HandlerMetricas(BaseHTTPRequestHandler):
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        body = PROMETHEUS.exponer().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def iniciar_servidor_metricas(logger: logging.Logger, puerto: int) -> Optional[ThreadingHTTPServer]:
+    if not puerto:
+        return None
+    servidor = ThreadingHTTPServer((cfg.METRICS_HOST, puerto), _HandlerMetricas)
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    logger.info("Métricas Prometheus en http://%s:%s/metrics", cfg.METRICS_HOST, servidor.server_address[1])
+    return servidor
+
+
+def _ruta_estado(nombre: str) -> str:
+    os.makedirs(cfg.STATE_DIR, exist_ok=True)
+    return os.path.join(cfg.STATE_DIR, nombre)
+
+
+def _escribir_json_atomico(ruta: str, data: Any) -> None:
+    tmp = f"{ruta}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, ruta)
+
+
 # =========================
 # HTTP helpers
 # =========================
+HEADERS_HTTP = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "application/json, text/plain, */*",
+}
+
+
 def crear_sesion() -> requests.Session:
     s = requests.Session()
-    s.headers.update({
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                      "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "application/json, text/plain, */*",
-    })
+    s.headers.update(HEADERS_HTTP)
     return s
 
 
-def request_seguro(method: str, url: str, logger: logging.Logger, session: requests.Session, **kwargs) -> requests.Response:
+def _leer_con_extractor(r: requests.Response, extractor: Any, cancelado: Optional[threading.Event] = None) -> None:
+    """Alimenta al extractor chunk a chunk y cierra la conexión apenas dice que terminó."""
+    try:
+        extractor.reiniciar()
+        for chunk in r.iter_content(chunk_size=cfg.HTTP_CHUNK_BYTES):
+            if extractor.alimentar(chunk) or (cancelado is not None and cancelado.is_set()):
+                break
+    finally:
+        r.close()
+
+
+# =========================
+# CIRCUIT BREAKER POR HOST
+# =========================
+class CircuitoAbierto(RuntimeError):
+    pass
+
+
+_CODIGO_CIRCUITO = {"cerrado": 0, "semiabierto": 1, "abierto": 2}
+
+
+def _es_falla_de_host(e: Exception) -> bool:
+    """
+    Cuentan contra el host los errores de red/transporte, los timeouts, los 5xx y los 429.
+    El resto de los 4xx y los errores propios (parseo, shutdown del executor...) no.
+    """
+    respuesta = getattr(e, "response", None)
+    status = getattr(respuesta, "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    if _es_timeout(e) or isinstance(e, requests.RequestException):
+        return True
+    return httpx is not None and isinstance(e, httpx.TransportError)
+
+
+class Disyuntores:
+    """
+    Un circuit breaker por host (cerrado -> abierto -> semiabierto -> cerrado), en
+    memoria durante todo el proceso (los ciclos del modo serve lo comparten) y
+    persistido en un JSON chico en STATE_DIR en cada cambio de estado, así una
+    corrida nueva no vuelve a golpear a un host que la anterior dejó abierto.
+    Las fechas se guardan en epoch (time.time) para que sirvan entre procesos.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._probando: Set[str] = set()
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                self._hosts: Dict[str, Dict[str, Any]] = json.load(f)
+        except (OSError, ValueError):
+            self._hosts = {}
+        for host, estado in self._hosts.items():
+            CIRCUITO_ESTADO.fijar(_CODIGO_CIRCUITO.get(estado.get("estado"), 0), host=host)
+
+    def _guardar(self) -> None:
+        try:
+            _escribir_json_atomico(self.ruta, self._hosts)
+        except OSError:
+            pass
+
+    def _fijar(self, host: str, estado: Dict[str, Any]) -> None:
+        self._hosts[host] = estado
+        CIRCUITO_ESTADO.fijar(_CODIGO_CIRCUITO[estado["estado"]], host=host)
+        self._guardar()
+
+    def permitir(self, host: str) -> None:
+        """Deja pasar la llamada o levanta CircuitoAbierto. Vencido el cooldown, pasa una sola sonda."""
+        with self._lock:
+            estado = self._hosts.get(host)
+            if estado is None or estado["estado"] == "cerrado":
+                return
+            restante = estado["abierto_hasta"] - time.time()
+            if restante <= 0 and host not in self._probando:
+                self._probando.add(host)
+                CIRCUITO_ESTADO.fijar(_CODIGO_CIRCUITO["semiabierto"], host=host)
+                return
+        CIRCUITO_RECHAZOS.incrementar(host=host)
+        if restante > 0:
+            raise CircuitoAbierto(f"circuito abierto para {host} (reintenta en {restante:.0f}s)")
+        raise CircuitoAbierto(f"circuito semiabierto para {host}: ya hay una sonda en curso")
+
+    def soltar_sonda(self, host: str) -> None:
+        with self._lock:
+            self._probando.discard(host)
+
+    def exito(self, host: str) -> bool:
+        """Devuelve True si el circuito estaba abierto y se cerró."""
+        with self._lock:
+            self._probando.discard(host)
+            estado = self._hosts.get(host)
+            if estado is None or (estado["estado"] == "cerrado" and not estado["fallas"]):
+                return False
+            self._fijar(host, {"estado": "cerrado", "fallas": 0, "abierto_hasta": 0.0, "cooldown": 0.0})
+            return estado["estado"] == "abierto"
+
+    def falla(self, host: str) -> bool:
+        """Cuenta una falla; devuelve True si con ella el circuito quedó abierto."""
+        with self._lock:
+            estado = self._hosts.get(host) or {"estado": "cerrado", "fallas": 0, "abierto_hasta": 0.0, "cooldown": 0.0}
+            if host in self._probando:
+                # Falló la sonda: vuelve a abrir con el doble de espera.
+                self._probando.discard(host)
+                cooldown = min(cfg.CIRCUIT_COOLDOWN_MAX_SECS, max(estado["cooldown"], cfg.CIRCUIT_COOLDOWN_SECS) * 2)
+            elif estado["fallas"] + 1 >= cfg.CIRCUIT_FAILURE_THRESHOLD:
+                cooldown = cfg.CIRCUIT_COOLDOWN_SECS
+            else:
+                self._hosts[host] = dict(estado, fallas=estado["fallas"] + 1)
+                return False
+            self._fijar(host, {
+                "estado": "abierto",
+                "fallas": estado["fallas"] + 1,
+                "abierto_hasta": time.time() + cooldown,
+                "cooldown": cooldown,
+            })
+            return True
+
+
+_disyuntores: Optional[Disyuntores] = None
+_lock_disyuntores = threading.Lock()
+
+
+def disyuntores() -> Optional[Disyuntores]:
+    global _disyuntores
+    if not cfg.CIRCUIT_BREAKER:
+        return None
+    with _lock_disyuntores:
+        if _disyuntores is None:
+            _disyuntores = Disyuntores(_ruta_estado("circuitos.json"))
+        return _disyuntores
+
+
+def _registrar_resultado_host(logger: logging.Logger, host: str, error: Optional[Exception]) -> None:
+    """Informa el resultado de un intento al breaker; si el circuito se abre, corta los reintentos."""
+    d = disyuntores()
+    if d is None:
+        return
+    if error is None:
+        if d.exito(host):
+            logger.info("Circuito cerrado para %s.", host, extra=kv(host=host, circuito="cerrado"))
+        return
+    if not _es_falla_de_host(error):
+        # Ni éxito ni falla del host (p. ej. un 404): si era la sonda, que pueda salir otra.
+        d.soltar_sonda(host)
+        return
+    if d.falla(host):
+        logger.warning("Circuito abierto para %s tras: %s", host, error, extra=kv(host=host, circuito="abierto"))
+        raise CircuitoAbierto(f"circuito abierto para {host}; último error: {error}") from error
+
+
+# =========================
+# RATE LIMIT POR HOST (token bucket)
+# =========================
+class BaldeTokens:
+    """
+    Token bucket con reserva: tomar() descuenta el token ya (el saldo puede quedar
+    negativo) y devuelve cuánto tiene que esperar quien llama. Así el lock nunca se
+    mantiene mientras se duerme, y sirve igual para time.sleep y asyncio.sleep.
+    """
+
+    def __init__(self, capacidad: float, por_segundo: float):
+        self.capacidad = capacidad
+        self.por_segundo = por_segundo
+        self.tokens = capacidad
+        self.ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _recargar(self, ahora: float) -> None:
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.por_segundo)
+        self.ultimo = ahora
+
+    def tomar(self) -> float:
+        with self._lock:
+            self._recargar(time.monotonic())
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.por_segundo)
+
+    def devolver(self) -> None:
+        """Devuelve el token de una llamada que al final no sale."""
+        with self._lock:
+            self.tokens = min(self.capacidad, self.tokens + 1)
+
+    def pausar(self, segundos: float) -> None:
+        """El servidor pidió esperar (429 + Retry-After): nadie sale antes de `segundos`."""
+        with self._lock:
+            self._recargar(time.monotonic())
+            self.tokens = min(self.tokens, -segundos * self.por_segundo)
+
+
+_baldes: Dict[str, BaldeTokens] = {}
+_lock_baldes = threading.Lock()
+
+
+def _balde(host: str) -> Optional[BaldeTokens]:
+    if not cfg.RATE_LIMIT:
+        return None
+    with _lock_baldes:
+        balde = _baldes.get(host)
+        if balde is None:
+            burst, por_segundo = cfg.RATE_LIMIT_BURST, cfg.RATE_LIMIT_PER_SEC
+            for nombre, b, r in cfg.RATE_LIMIT_HOSTS:
+                if host == nombre or host.endswith("." + nombre):
+                    burst, por_segundo = b, r
+                    break
+            balde = _baldes[host] = BaldeTokens(burst, por_segundo)
+        return balde
+
+
+def _espera_limite(host: str) -> float:
+    """
+    Toma un token del host y devuelve cuánto dormir. Si el turno llega después del
+    presupuesto de la corrida, devuelve el token y levanta PresupuestoAgotado: salir
+    antes rompería el límite del host, y salir a tiempo, el presupuesto.
+    """
+    balde = _balde(host)
+    if balde is None:
+        return 0.0
+    espera = balde.tomar()
+    presupuesto = _presupuesto_actual.get()
+    if presupuesto is not None and espera > presupuesto.restante():
+        balde.devolver()
+        raise PresupuestoAgotado(
+            f"Presupuesto de {presupuesto.segundos:g}s de la corrida agotado: el rate limit de {host} pide esperar {espera:.1f}s"
+        )
+    LIMITE_ESPERA.observar(espera, host=host)
+    return espera
+
+
+def _respetar_retry_after(logger: logging.Logger, host: str, e: Exception) -> None:
+    respuesta = getattr(e, "response", None)
+    if getattr(respuesta, "status_code", None) != 429:
+        return
+    try:
+        segundos = float(respuesta.headers.get("Retry-After", ""))
+    except ValueError:
+        return
+    balde = _balde(host)
+    if balde is not None:
+        logger.warning("%s pidió esperar %.0fs (429): freno todas las llamadas a ese host.", host, segundos)
+        balde.pausar(segundos)
+
+
+# =========================
+# TIMEOUTS ADAPTATIVOS (histograma de latencias por endpoint)
+# =========================
+# Límites de los buckets en segundos: de 10ms a ~60s, 25% más anchos cada uno.
+_LIMITES_LATENCIA: Tuple[float, ...] = tuple(0.01 * 1.25 ** k for k in range(40))
+
+
+def _endpoint(method: str, url: str) -> str:
+    partes = urlsplit(url)
+    return f"{method.upper()} {partes.netloc}{partes.path}"
+
+
+def _es_timeout(e: Exception) -> bool:
+    if isinstance(e, (requests.Timeout, asyncio.TimeoutError, TimeoutError)):
+        return True
+    return httpx is not None and isinstance(e, httpx.TimeoutException)
+
+
+class LatenciasHTTP:
+    """
+    Histograma de latencias por endpoint, compartido por todo el proceso y guardado
+    en STATE_DIR (a lo sumo cada 30s y al salir) para que la corrida siguiente ya
+    arranque con timeouts ajustados. Sólo se cuentan intentos con respuesta o con
+    timeout: estos entran con el tiempo esperado, así un host que se pone lento
+    empuja el p99 hacia arriba en vez de quedar trabado en un timeout corto.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._guardado = time.monotonic()
+        self._sucio = False
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            datos = {}
+        self._conteos: Dict[str, List[float]] = {
+            endpoint: conteos for endpoint, conteos in datos.items() if len(conteos) == len(_LIMITES_LATENCIA) + 1
+        }
+
+    def registrar(self, endpoint: str, segundos: float) -> None:
+        with self._lock:
+            conteos = self._conteos.setdefault(endpoint, [0.0] * (len(_LIMITES_LATENCIA) + 1))
+            conteos[bisect.bisect_left(_LIMITES_LATENCIA, segundos)] += 1
+            if sum(conteos) > cfg.HTTP_LATENCY_WINDOW:
+                conteos[:] = [c / 2 for c in conteos]
+            self._sucio = True
+            if time.monotonic() - self._guardado < 30:
+                return
+        self.guardar()
+
+    def percentil(self, endpoint: str, q: float) -> Optional[float]:
+        """Límite superior del bucket que contiene el percentil q, o None con pocas muestras."""
+        with self._lock:
+            conteos = list(self._conteos.get(endpoint, ()))
+        total = sum(conteos)
+        if total < cfg.HTTP_LATENCY_MIN_SAMPLES:
+            return None
+        acumulado = 0.0
+        for limite, conteo in zip(_LIMITES_LATENCIA, conteos):
+            acumulado += conteo
+            if acumulado >= q * total:
+                return limite
+        return None  # cae en el bucket abierto (más de ~60s)
+
+    def guardar(self) -> None:
+        with self._lock:
+            if not self._sucio:
+                return
+            datos = {endpoint: list(conteos) for endpoint, conteos in self._conteos.items()}
+            self._sucio = False
+            self._guardado = time.monotonic()
+        try:
+            _escribir_json_atomico(self.ruta, datos)
+        except OSError:
+            pass
+
+
+_latencias: Optional[LatenciasHTTP] = None
+_lock_latencias = threading.Lock()
+
+
+def latencias_http() -> Optional[LatenciasHTTP]:
+    global _latencias
+    if not cfg.HTTP_ADAPTIVE_TIMEOUT:
+        return None
+    with _lock_latencias:
+        if _latencias is None:
+            _latencias = LatenciasHTTP(_ruta_estado("latencias.json"))
+            atexit.register(_latencias.guardar)
+        return _latencias
+
+
+def _timeout_lectura(method: str, url: str, intento: int) -> float:
+    """p99 x factor acotado a [piso, HTTP_TIMEOUT_SECS], y el doble por cada reintento."""
+    latencias = latencias_http()
+    p99 = latencias.percentil(_endpoint(method, url), 0.99) if latencias is not None else None
+    if p99 is None:
+        return cfg.HTTP_TIMEOUT_SECS
+    base = max(cfg.HTTP_TIMEOUT_FLOOR_SECS, p99 * cfg.HTTP_TIMEOUT_P99_FACTOR)
+    timeout = min(cfg.HTTP_TIMEOUT_SECS, base * 2 ** (intento - 1))
+    HTTP_TIMEOUT.fijar(round(timeout, 3), endpoint=_endpoint(method, url))
+    return timeout
+
+
+def _registrar_latencia(method: str, url: str, segundos: float, error: Optional[Exception] = None) -> None:
+    latencias = latencias_http()
+    if latencias is None:
+        return
+    if error is None or _es_timeout(error) or getattr(error, "response", None) is not None:
+        latencias.registrar(_endpoint(method, url), segundos)
+
+
+def request_seguro(
+    method: str,
+    url: str,
+    logger: logging.Logger,
+    session: requests.Session,
+    extractor: Any = None,
+    **kwargs,
+) -> requests.Response:
+    """
+    Con `extractor` (objeto con reiniciar() y alimentar(chunk) -> bool) el body
+    se lee en streaming dentro del mismo intento, y la respuesta vuelve ya cerrada.
+    """
+    host = urlsplit(url).netloc
     ultimo_error: Optional[Exception] = None
     for intento in range(1, cfg.HTTP_RETRIES + 1):
+        d = disyuntores()
+        if d is not None:
+            d.permitir(host)
         try:
-            logger.debug(f"HTTP {method} intento {intento}/{cfg.HTTP_RETRIES}: {url}")
-            r = session.request(method, url, timeout=cfg.HTTP_TIMEOUT_SECS, **kwargs)
-            r.raise_for_status()
-            return r
+            espera = _espera_limite(host)
+            if espera > 0:
+                logger.debug("Rate limit de %s: espero %.3fs.", host, espera)
+                time.sleep(espera)
+            # Después de la espera: el timeout se recorta a lo que queda del presupuesto ahora.
+            timeout = _timeouts_intento(
+                f"{method} {url} (intento {intento}/{cfg.HTTP_RETRIES}); último error: {ultimo_error}",
+                _timeout_lectura(method, url, intento),
+            )
+        except BaseException:
+            if d is not None:
+                d.soltar_sonda(host)
+            raise
+        t0 = time.monotonic()
+        try:
+            logger.debug("HTTP %s intento %d/%d: %s", method, intento, cfg.HTTP_RETRIES, url)
+            with span("http", metodo=method, url=url, intento=intento) as campos:
+                r = session.request(method, url, timeout=timeout, stream=extractor is not None, **kwargs)
+                if r.status_code >= 400:
+                    r.close()
+                if extractor is not None and r.status_code < 400:
+                    _leer_con_extractor(r, extractor)
+                _medir_respuesta(campos, r, extractor)
+                r.raise_for_status()
         except Exception as e:
             ultimo_error = e
-            logger.warning(f"Error HTTP (intento {intento}/{cfg.HTTP_RETRIES}) hacia {url}: {e}")
+            logger.warning(
+                "Error HTTP (intento %d/%d) hacia %s: %s", intento, cfg.HTTP_RETRIES, url, e,
+                extra=kv(metodo=method, url=url, intento=intento, error=type(e).__name__),
+            )
+            _registrar_latencia(method, url, time.monotonic() - t0, e)
+            _respetar_retry_after(logger, host, e)
+            _registrar_resultado_host(logger, host, e)
+        except BaseException:
+            # KeyboardInterrupt, SystemExit...: no dice nada del host, pero libera la sonda.
+            if d is not None:
+                d.soltar_sonda(host)
+            raise
+        else:
+            _registrar_latencia(method, url, time.monotonic() - t0)
+            _registrar_resultado_host(logger, host, None)
+            return r
+        if intento < cfg.HTTP_RETRIES:
+            presupuesto = _presupuesto_actual.get()
+            espera = _espera_backoff(intento)
+            if presupuesto is not None:
+                # El intento pudo consumir lo que quedaba: cortar acá, no dormir un tiempo negativo.
+                presupuesto.verificar(f"reintento de {method} {url}; último error: {ultimo_error}")
+                espera = min(espera, max(0.0, presupuesto.restante()))
+            time.sleep(espera)
     raise RuntimeError(f"Fallo HTTP luego de {cfg.HTTP_RETRIES} reintentos: {url}. Último error: {ultimo_error}")
 
 
+def _espera_backoff(intento: int) -> float:
+    # Backoff exponencial con "full jitter": U(0, min(max, base * 2^(intento-1)))
+    tope = min(cfg.HTTP_BACKOFF_MAX_SECS, cfg.HTTP_BACKOFF_BASE_SECS * (2 ** (intento - 1)))
+    return random.uniform(0, tope)
+
+
+class ClienteHTTPAsync:
+    """
+    Cliente HTTP async con pool de conexiones, para tener muchas llamadas en vuelo
+    desde un solo event loop. Usa httpx si está instalado; si no, corre una sesión
+    de requests en un pool acotado de threads (cancelar deja de esperar y descarta
+    la respuesta). Se usa como `async with ClienteHTTPAsync() as cliente: ...`.
+    """
+
+    def __init__(self, max_conexiones: int = cfg.HTTP_ASYNC_MAX_CONNECTIONS):
+        self._cliente = None
+        self._sesion: Optional[requests.Session] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        # Tope de requests en vuelo por host (se crean en el loop que las usa).
+        self._por_host: Dict[str, asyncio.Semaphore] = {}
+
+        if httpx is not None:
+            self._cliente = httpx.AsyncClient(
+                headers=HEADERS_HTTP,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=max_conexiones, max_keepalive_connections=max_conexiones),
+            )
+        else:
+            self._sesion = crear_sesion()
+            adapter = HTTPAdapter(pool_connections=max_conexiones, pool_maxsize=max_conexiones)
+            self._sesion.mount("https://", adapter)
+            self._sesion.mount("http://", adapter)
+            self._pool = ThreadPoolExecutor(max_workers=max_conexiones, thread_name_prefix="http-async")
+
+    @property
+    def backend(self) -> str:
+        return "httpx" if self._cliente is not None else "requests+threads"
+
+    async def request(self, method: str, url: str, timeout: Tuple[float, float], extractor: Any = None, **kwargs) -> Any:
+        """`timeout` es (connect, read), como en requests. Con `extractor`, ver request_seguro()."""
+        host = urlsplit(url).netloc
+        if host not in self._por_host:
+            self._por_host[host] = asyncio.Semaphore(cfg.HTTP_MAX_CONCURRENCY_PER_HOST)
+
+        async with self._por_host[host]:
+            if self._cliente is not None:
+                connect, read = timeout
+                timeout_httpx = httpx.Timeout(read, connect=connect)
+                if _span_actual.get() is not None:
+                    kwargs.setdefault("extensions", {})["trace"] = _traza_httpx()
+                if extractor is None:
+                    return await self._cliente.request(method, url, timeout=timeout_httpx, **kwargs)
+                async with self._cliente.stream(method, url, timeout=timeout_httpx, **kwargs) as r:
+                    if r.status_code < 400:
+                        extractor.reiniciar()
+                        async for chunk in r.aiter_bytes(cfg.HTTP_CHUNK_BYTES):
+                            if extractor.alimentar(chunk):
+                                break
+                    return r
+
+            loop = asyncio.get_running_loop()
+            if extractor is None:
+                llamada = functools.partial(self._sesion.request, method, url, timeout=timeout, **kwargs)
+                return await loop.run_in_executor(self._pool, llamada)
+
+            # En el thread no hay cancelación real: el evento corta la lectura en el próximo chunk.
+            cancelado = threading.Event()
+
+            def leer() -> requests.Response:
+                r = self._sesion.request(method, url, timeout=timeout, stream=True, **kwargs)
+                if r.status_code < 400:
+                    _leer_con_extractor(r, extractor, cancelado)
+                else:
+                    r.close()
+                return r
+
+            try:
+                return await loop.run_in_executor(self._pool, leer)
+            except asyncio.CancelledError:
+                cancelado.set()
+                raise
+
+    async def cerrar(self) -> None:
+        if self._cliente is not None:
+            await self._cliente.aclose()
+        else:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._sesion.close()
+
+    async def __aenter__(self) -> "ClienteHTTPAsync":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.cerrar()
+
+
+# Fases de httpcore que vale la pena separar en el span (connect incluye la resolución DNS).
+_FASES_HTTPX = {
+    "connection.connect_tcp": "connect_ms",
+    "connection.start_tls": "tls_ms",
+    "http11.receive_response_headers": "espera_headers_ms",
+    "http2.receive_response_headers": "espera_headers_ms",
+}
+
+
+def _traza_httpx() -> Callable[[str, Dict[str, Any]], Awaitable[None]]:
+    """Callback de `extensions={"trace": ...}` de httpx: duración por fase y TTFB en el span en curso."""
+    t0 = time.monotonic()
+    inicios: Dict[str, float] = {}
+
+    async def traza(evento: str, info: Dict[str, Any]) -> None:
+        fase, _, estado = evento.rpartition(".")
+        ahora = time.monotonic()
+        if estado == "started":
+            inicios[fase] = ahora
+        elif estado == "complete" and fase in _FASES_HTTPX and fase in inicios:
+            _marcar_span(**{_FASES_HTTPX[fase]: round((ahora - inicios[fase]) * 1e3, 2)})
+            if _FASES_HTTPX[fase] == "espera_headers_ms":
+                _marcar_span(ttfb_ms=round((ahora - t0) * 1e3, 2))
+
+    return traza
+
+
+async def request_seguro_async(
+    method: str,
+    url: str,
+    logger: logging.Logger,
+    cliente: ClienteHTTPAsync,
+    retries: Optional[int] = None,
+    deadline_secs: Optional[float] = None,
+    extractor: Any = None,
+    **kwargs,
+) -> Any:
+    """
+    Equivalente async de request_seguro(): reintenta con backoff exponencial + jitter
+    y corta todo al superar `deadline_secs` (por defecto cfg.HTTP_DEADLINE_SECS)
+    o el presupuesto de la corrida, lo que venza antes. La cancelación del task
+    se propaga tal cual (no se reintenta). Con `extractor`, el body se lee en
+    streaming como en request_seguro().
+    """
+    retries = retries or cfg.HTTP_RETRIES
+    deadline_secs = deadline_secs or cfg.HTTP_DEADLINE_SECS
+    limite = time.monotonic() + deadline_secs
+    presupuesto = _presupuesto_actual.get()
+    if presupuesto is not None:
+        limite = min(limite, presupuesto.limite)
+    host = urlsplit(url).netloc
+    ultimo_error: Optional[Exception] = None
+    intentos = 0
+
+    for intento in range(1, retries + 1):
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        intentos = intento
+        d = disyuntores()
+        if d is not None:
+            d.permitir(host)
+        try:
+            espera = _espera_limite(host)
+            if espera > 0:
+                logger.debug("Rate limit de %s: espero %.3fs.", host, espera)
+                await asyncio.sleep(espera)
+        except BaseException:
+            if d is not None:
+                d.soltar_sonda(host)
+            raise
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            if d is not None:
+                d.soltar_sonda(host)
+            break
+        t0 = time.monotonic()
+        try:
+            logger.debug("HTTP async %s intento %d/%d: %s", method, intento, retries, url)
+            timeout = _timeouts_intento(
+                f"{method} {url} (intento {intento}/{retries})", min(_timeout_lectura(method, url, intento), restante)
+            )
+            with span("http", metodo=method, url=url, intento=intento) as campos:
+                llamada = cliente.request(method, url, timeout=timeout, extractor=extractor, **kwargs)
+                r = await asyncio.wait_for(llamada, timeout=restante)
+                _medir_respuesta(campos, r, extractor)
+                if r.status_code >= 400:
+                    r.raise_for_status()
+        except (PresupuestoAgotado, asyncio.CancelledError):
+            # Ni éxito ni falla del host: si esta era la sonda, otra llamada puede probar.
+            if d is not None:
+                d.soltar_sonda(host)
+            raise
+        except asyncio.TimeoutError:
+            ultimo_error = TimeoutError(f"deadline de {deadline_secs}s agotado")
+            logger.warning("Error HTTP async (intento %d/%d) hacia %s: %s", intento, retries, url, ultimo_error)
+            _registrar_resultado_host(logger, host, ultimo_error)
+            break
+        except Exception as e:
+            ultimo_error = e
+            logger.warning(
+                "Error HTTP async (intento %d/%d) hacia %s: %s", intento, retries, url, e,
+                extra=kv(metodo=method, url=url, intento=intento, error=type(e).__name__),
+            )
+            _registrar_latencia(method, url, time.monotonic() - t0, e)
+            _respetar_retry_after(logger, host, e)
+            _registrar_resultado_host(logger, host, e)
+        except BaseException:
+            if d is not None:
+                d.soltar_sonda(host)
+            raise
+        else:
+            _registrar_latencia(method, url, time.monotonic() - t0)
+            _registrar_resultado_host(logger, host, None)
+            return r
+
+        if intento < retries:
+            await asyncio.sleep(min(_espera_backoff(intento), max(0.0, limite - time.monotonic())))
+
+    if presupuesto is not None:
+        presupuesto.verificar(f"{method} {url}; último error: {ultimo_error}")
+    raise RuntimeError(f"Fallo HTTP async luego de {intentos}/{retries} intentos: {url}. Último error: {ultimo_error}")
+
+
+_loop_async: Optional[asyncio.AbstractEventLoop] = None
+_cliente_async: Optional[ClienteHTTPAsync] = None
+_lock_loop = threading.Lock()
+
+
+def correr_async(fabrica: Callable[[ClienteHTTPAsync], Awaitable[Any]]) -> Any:
+    """
+    Corre `fabrica(cliente)` en un event loop de fondo que vive todo el proceso, con un
+    único ClienteHTTPAsync compartido: las conexiones (y el TLS) quedan calientes entre
+    llamadas y entre ciclos del modo serve. Bloquea hasta tener el resultado.
+    El task hereda el contexto de quien llama (presupuesto de la corrida incluido).
+    """
+    global _loop_async, _cliente_async
+    with _lock_loop:
+        if _loop_async is None:
+            _loop_async = asyncio.new_event_loop()
+            threading.Thread(target=_loop_async.run_forever, name="loop-async", daemon=True).start()
+
+            async def crear() -> ClienteHTTPAsync:
+                return ClienteHTTPAsync()
+
+            _cliente_async = asyncio.run_coroutine_threadsafe(crear(), _loop_async).result()
+
+    return asyncio.run_coroutine_threadsafe(fabrica(_cliente_async), _loop_async).result()
+
+
+def esperar_refrescos_cache() -> None:
+    """Deja terminar los refrescos SWR en curso (acotados por el presupuesto de una corrida) antes de cerrar el loop."""
+    if _cache_cotizaciones is not None:
+        _cache_cotizaciones.esperar_refrescos(cfg.RUN_DEADLINE_SECS if cfg.RUN_DEADLINE_SECS > 0 else None)
+
+
+async def _cancelar_y_cerrar(cliente: ClienteHTTPAsync) -> None:
+    # Lo que quedó en vuelo (p. ej. la otra etapa cuando una falló) no tiene que seguir
+    # corriendo, y logueando, hasta el apagado del intérprete.
+    actual = asyncio.current_task()
+    pendientes = [t for t in asyncio.all_tasks() if t is not actual]
+    for t in pendientes:
+        t.cancel()
+    await asyncio.gather(*pendientes, return_exceptions=True)
+    await cliente.cerrar()
+
+
+def cerrar_async() -> None:
+    """Cancela los tasks pendientes y cierra el cliente y el event loop de fondo."""
+    global _loop_async, _cliente_async
+    with _lock_loop:
+        if _loop_async is None:
+            return
+        asyncio.run_coroutine_threadsafe(_cancelar_y_cerrar(_cliente_async), _loop_async).result()
+        _loop_async.call_soon_threadsafe(_loop_async.stop)
+        _loop_async, _cliente_async = None, None
+
+
 # =========================
 # Parsing de montos
 # =========================
@@ -136,118 +1507,784 @@ def _formatear_pesos(valor: float) -> str:
 # =========================
 # DOLARHOY (Blue) - parser por estructura topic/value
 # =========================
-def obtener_dolar_blue(logger: logging.Logger, session: requests.Session) -> Tuple[float, float]:
+# Un único patrón (compilado una vez, sobre bytes) para todos los pares topic/value.
+_PATRON_TOPIC_VALUE = re.compile(
+    rb'<div\s+class="topic">\s*([^<]{1,40}?)\s*</div>\s*<div\s+class="value">\s*\$?\s*([0-9\.,]+)\s*</div>',
+    re.IGNORECASE
+)
+
+
+def _extraer_topic_value(contenido: bytes, desde: int = 0, en: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Una sola pasada sobre los bytes: {"compra": "1485,00", "venta": "1505,00", ...}.
+    Si un topic se repite, queda el primero.
+    """
+    pares = {} if en is None else en
+    for m in _PATRON_TOPIC_VALUE.finditer(contenido, desde):
+        topic = m.group(1).decode("utf-8", "replace").strip().lower()
+        if topic not in pares:
+            pares[topic] = m.group(2).decode("ascii")
+    return pares
+
+
+def _extraer_compra_venta(contenido: bytes) -> Optional[Tuple[float, float]]:
     """
     Parseo basado en tu estructura real:
     <div class="topic">Compra</div><div class="value">$1485,00</div>
     <div class="topic">Venta</div><div class="value">$1505,00</div>
+    Devuelve (compra, venta) o None si no aparecen las dos.
+    """
+    # Ubicamos el bloque real de cotizacion_moneda: el primero después del </head>
+    # (en el <head> sólo hay definiciones de CSS). Es la misma regla que usa
+    # _ExtractorDolarhoy, que así puede cortar apenas lo lee; los bloques que vengan
+    # después (oficial, MEP...) no cuentan.
+    cuerpo = contenido.find(b"</head>")
+    idx = contenido.find(b"cotizacion_moneda", cuerpo) if cuerpo != -1 else -1
+    pares = _extraer_topic_value(contenido, max(idx, 0))
+    if idx > 0 and ("compra" not in pares or "venta" not in pares):
+        pares = _extraer_topic_value(contenido[:idx], en=pares)
+
+    if "compra" not in pares or "venta" not in pares:
+        return None
+    return _parsear_monto(pares["compra"]), _parsear_monto(pares["venta"])
+
+
+class _ExtractorDolarhoy:
     """
-    import re
+    Extractor en streaming: busca Compra/Venta a medida que llegan los chunks sobre
+    un buffer rodante de bytes (sólo se guarda la cola, por si un match queda partido
+    entre dos chunks). alimentar() devuelve True cuando ya están las dos y se puede cortar.
+    Misma regla que _extraer_compra_venta(): sólo vale lo que viene después del primer
+    cotizacion_moneda pasado el </head> (así no cuentan las reglas CSS ni los bloques
+    siguientes); si la página no lo trae, al final del body se usa el primer par que
+    haya aparecido. fixtures/dolarhoy_dos_bloques.html tiene más de un bloque.
+    """
+
+    COLA_BYTES = 4096
+    ANCLA = b"cotizacion_moneda"
+    FIN_HEAD = b"</head>"
+
+    def __init__(self):
+        self.reiniciar()
+
+    def reiniciar(self) -> None:
+        self._buffer = b""
+        self._pares: Dict[str, str] = {}
+        self._sin_ancla: Dict[str, str] = {}
+        self._en_body = False
+        self._anclado = False
+        self._leido = bytearray()
+        self.bytes_leidos = 0
+
+    def alimentar(self, chunk: bytes) -> bool:
+        self.bytes_leidos += len(chunk)
+        self._leido += chunk
+        self._buffer += chunk
+        if not self._en_body:
+            i = self._buffer.find(self.FIN_HEAD)
+            if i != -1:
+                self._en_body = True
+                self._buffer = self._buffer[i:]
+        if self._en_body and not self._anclado:
+            i = self._buffer.find(self.ANCLA)
+            if i != -1:
+                _extraer_topic_value(self._buffer[:i], en=self._sin_ancla)
+                self._anclado = True
+                self._buffer = self._buffer[i:]
+        _extraer_topic_value(self._buffer, en=self._pares if self._anclado else self._sin_ancla)
+
+        if "compra" in self._pares and "venta" in self._pares:
+            self._leido = bytearray()
+            return True
+        self._buffer = self._buffer[-self.COLA_BYTES:]
+        return False
+
+    def resultado(self) -> Optional[Tuple[float, float]]:
+        pares = dict(self._sin_ancla, **self._pares)
+        if "compra" not in pares or "venta" not in pares:
+            return None
+        return _parsear_monto(pares["compra"]), _parsear_monto(pares["venta"])
+
+    def html(self) -> bytes:
+        """
+        Lo leído, para el dump de debug: mientras no hubo match se guarda el body entero
+        (justo el caso "cambió el HTML"); después del corte temprano, sólo la cola.
+        """
+        return bytes(self._leido) or self._buffer
+
+
+class CacheCondicional:
+    """
+    Por URL: validadores HTTP (ETag / Last-Modified) y el último Compra/Venta parseado,
+    en un JSON chico en STATE_DIR. Permite pedir la página en forma condicional y,
+    ante un 304, reusar el resultado sin bajar ni parsear nada.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._datos: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _entradas(self) -> Dict[str, Dict[str, Any]]:
+        if self._datos is None:
+            try:
+                with open(self.ruta, "r", encoding="utf-8") as f:
+                    self._datos = json.load(f)
+            except (OSError, ValueError):
+                self._datos = {}
+        return self._datos
+
+    def headers(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            entrada = self._entradas().get(url) or {}
+        headers = {}
+        if entrada.get("etag"):
+            headers["If-None-Match"] = entrada["etag"]
+        if entrada.get("last_modified"):
+            headers["If-Modified-Since"] = entrada["last_modified"]
+        return headers
+
+    def resultado(self, url: str) -> Optional[Tuple[float, float]]:
+        with self._lock:
+            entrada = self._entradas().get(url)
+        if not entrada:
+            return None
+        return entrada["compra"], entrada["venta"]
+
+    def guardar(self, url: str, headers: Any, par: Tuple[float, float]) -> None:
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self._lock:
+            self._entradas()[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "compra": par[0],
+                "venta": par[1],
+                "guardado": datetime.now().isoformat(timespec="seconds"),
+            }
+            _escribir_json_atomico(self.ruta, self._datos)
+
+
+_cache_condicional: Optional[CacheCondicional] = None
+
+
+def _cache_dolarhoy() -> CacheCondicional:
+    global _cache_condicional
+    if _cache_condicional is None:
+        _cache_condicional = CacheCondicional(_ruta_estado("dolarhoy_validadores.json"))
+    return _cache_condicional
+
+
+def _headers_dolarhoy(url: str) -> Dict[str, str]:
+    return _cache_dolarhoy().headers(url) if cfg.DOLARHOY_CONDITIONAL_GET else {}
+
+
+def _procesar_respuesta_dolarhoy(
+    logger: logging.Logger, url: str, r: Any, extractor: Optional[_ExtractorDolarhoy]
+) -> Tuple[Optional[Tuple[float, float]], bytes]:
+    """Devuelve (compra/venta o None, html para debug), resolviendo los 304 contra el cache."""
+    if r.status_code == 304:
+        logger.info("Dolarhoy sin cambios (304) en %s: reuso Compra/Venta guardados.", url)
+        CACHE_CONSULTAS.incrementar(cache="condicional", fuente="dolarhoy", resultado="hit")
+        return _cache_dolarhoy().resultado(url), b""
+    if cfg.DOLARHOY_CONDITIONAL_GET:
+        CACHE_CONSULTAS.incrementar(cache="condicional", fuente="dolarhoy", resultado="miss")
+
+    with span("parse_dolarhoy", url=url, streaming=extractor is not None) as campos:
+        if extractor is not None:
+            logger.debug("Dolarhoy streaming: %d bytes leídos de %s", extractor.bytes_leidos, url)
+            par, html = extractor.resultado(), extractor.html()
+        else:
+            html = r.content
+            par = _extraer_compra_venta(html)
+        campos["ok"] = par is not None
+
+    if par is not None and cfg.DOLARHOY_CONDITIONAL_GET:
+        _cache_dolarhoy().guardar(url, r.headers, par)
+    return par, html
+
+
+def _descargar_compra_venta(logger: logging.Logger, session: requests.Session, url: str) -> Tuple[Optional[Tuple[float, float]], bytes]:
+    """Baja la página (condicional y en streaming si está habilitado) y devuelve (compra/venta o None, html para debug)."""
+    extractor = _ExtractorDolarhoy() if cfg.DOLARHOY_STREAMING else None
+    r = request_seguro("GET", url, logger, session, extractor=extractor, headers=_headers_dolarhoy(url))
+    return _procesar_respuesta_dolarhoy(logger, url, r, extractor)
+
+
+def _guardar_debug_dolarhoy(url: Optional[str], html: Optional[bytes]) -> None:
+    if html is None:
+        return
+    with open("logs/dolarhoy_debug.html", "wb") as f:
+        f.write(f"<!-- URL: {url} -->\n\n".encode("utf-8"))
+        f.write(html)
 
+
+def obtener_dolar_blue(logger: logging.Logger, session: requests.Session) -> Tuple[float, float]:
     logger.info("Obteniendo Dólar Blue desde Dolarhoy...")
 
-    # Regex estricta a topic/value
-    patron_compra = re.compile(
-        r'<div\s+class="topic">\s*Compra\s*</div>\s*<div\s+class="value">\s*\$?\s*([0-9\.,]+)\s*</div>',
-        re.IGNORECASE | re.DOTALL
-    )
-    patron_venta = re.compile(
-        r'<div\s+class="topic">\s*Venta\s*</div>\s*<div\s+class="value">\s*\$?\s*([0-9\.,]+)\s*</div>',
-        re.IGNORECASE | re.DOTALL
-    )
+    if cfg.DOLARHOY_HEDGE and len(cfg.DOLARHOY_URLS) > 1:
+        return correr_async(lambda cliente: _obtener_dolar_blue_hedged(logger, cliente))
 
-    ultimo_html: Optional[str] = None
+    ultimo_html: Optional[bytes] = None
     ultima_url: Optional[str] = None
+    circuito: Optional[CircuitoAbierto] = None
 
     for url in cfg.DOLARHOY_URLS:
-        logger.info(f"Consultando: {url}")
+        logger.info("Consultando: %s", url)
         try:
-            r = request_seguro("GET", url, logger, session)
-            html = r.text
-            ultimo_html = html
+            par, ultimo_html = _descargar_compra_venta(logger, session, url)
             ultima_url = url
 
-            # Ubicamos el bloque real de cotizacion_moneda.
-            # Usamos rfind para esquivar definiciones de CSS en el <head>.
-            lower = html.lower()
-            idx = lower.rfind("cotizacion_moneda")
-            ventana = html[idx:] if idx != -1 else html
-
-            m_c = patron_compra.search(ventana) or patron_compra.search(html)
-            m_v = patron_venta.search(ventana) or patron_venta.search(html)
-
-            if not m_c or not m_v:
-                logger.warning(f"No se encontró Compra/Venta en {url} (sigo probando otra URL).")
+            if par is None:
+                logger.warning("No se encontró Compra/Venta en %s (sigo probando otra URL).", url)
                 continue
 
-            compra = _parsear_monto(m_c.group(1))
-            venta = _parsear_monto(m_v.group(1))
-
-            logger.info(f"Dólar Blue obtenido OK desde {url}: compra={_formatear_pesos(compra)} venta={_formatear_pesos(venta)}")
+            compra, venta = par
+            logger.info(
+                "Dólar Blue obtenido OK desde %s: compra=%s venta=%s", url, _formatear_pesos(compra), _formatear_pesos(venta),
+                extra=kv(url=url, compra=compra, venta=venta),
+            )
             return compra, venta
 
+        except PresupuestoAgotado:
+            raise
+        except CircuitoAbierto as e:
+            logger.warning("Dolarhoy en %s: %s", url, e)
+            circuito = e
         except Exception as e:
-            logger.warning(f"Error consultando/parsing Dolarhoy en {url}: {e}")
+            logger.warning("Error consultando/parsing Dolarhoy en %s: %s", url, e)
+
+    if circuito is not None and ultimo_html is None:
+        # No llegó ninguna página: no hay HTML que guardar y el que llama puede usar el cache.
+        raise circuito
 
     logger.error("No se pudo parsear Compra/Venta en Dolarhoy. Guardando HTML en logs/dolarhoy_debug.html")
-    if ultimo_html is not None:
-        with open("logs/dolarhoy_debug.html", "w", encoding="utf-8") as f:
-            f.write(f"<!-- URL: {ultima_url} -->\n\n")
-            f.write(ultimo_html)
+    _guardar_debug_dolarhoy(ultima_url, ultimo_html)
 
     raise RuntimeError("No se pudo parsear el Dólar Blue (compra/venta) desde Dolarhoy (cambió el HTML).")
 
 
+async def _obtener_dolar_blue_hedged(logger: logging.Logger, cliente: ClienteHTTPAsync) -> Tuple[float, float]:
+    """
+    Modo "hedged": arranca la URL principal y dispara cada espejo cuando pasa
+    DOLARHOY_HEDGE_DELAY_SECS o cuando falla la anterior (lo que ocurra primero).
+    Gana la primera respuesta que parsea a Compra/Venta; el resto se cancela.
+    """
+    urls = cfg.DOLARHOY_URLS
+    disparos = [asyncio.Event() for _ in urls]
+    disparos[0].set()
+    ultimo: Dict[str, Any] = {"url": None, "html": None}
+
+    async def intentar(i: int, url: str) -> Tuple[str, Tuple[float, float]]:
+        try:
+            try:
+                await asyncio.wait_for(disparos[i].wait(), timeout=cfg.DOLARHOY_HEDGE_DELAY_SECS * i)
+            except asyncio.TimeoutError:
+                pass
+            logger.info("Consultando (hedged %d/%d): %s", i + 1, len(urls), url)
+            extractor = _ExtractorDolarhoy() if cfg.DOLARHOY_STREAMING else None
+            r = await request_seguro_async("GET", url, logger, cliente, extractor=extractor, headers=_headers_dolarhoy(url))
+            par, html = _procesar_respuesta_dolarhoy(logger, url, r, extractor)
+            ultimo["url"], ultimo["html"] = url, html
+            if par is None:
+                raise ValueError("no se encontró Compra/Venta")
+            return url, par
+        except Exception:
+            # Si esta falla, no tiene sentido que el siguiente espejo siga esperando.
+            if i + 1 < len(disparos):
+                disparos[i + 1].set()
+            raise
+
+    tareas = [asyncio.create_task(intentar(i, u)) for i, u in enumerate(urls)]
+    circuito: Optional[CircuitoAbierto] = None
+    try:
+        for siguiente in asyncio.as_completed(tareas):
+            try:
+                url, (compra, venta) = await siguiente
+            except CircuitoAbierto as e:
+                logger.warning("Dolarhoy (hedged): %s", e)
+                circuito = e
+                continue
+            except Exception as e:
+                logger.warning("Error consultando/parsing Dolarhoy (hedged): %s", e)
+                continue
+            logger.info(
+                "Dólar Blue obtenido OK desde %s: compra=%s venta=%s", url, _formatear_pesos(compra), _formatear_pesos(venta),
+                extra=kv(url=url, compra=compra, venta=venta),
+            )
+            return compra, venta
+    finally:
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+    presupuesto = _presupuesto_actual.get()
+    if presupuesto is not None:
+        presupuesto.verificar("obtener Compra/Venta de Dolarhoy")
+    if circuito is not None and ultimo["html"] is None:
+        raise circuito
+
+    logger.error("No se pudo parsear Compra/Venta en Dolarhoy. Guardando HTML en logs/dolarhoy_debug.html")
+    _guardar_debug_dolarhoy(ultimo["url"], ultimo["html"])
+    raise RuntimeError("No se pudo parsear el Dólar Blue (compra/venta) desde Dolarhoy (cambió el HTML).")
+
+
 # =========================
 # BINANCE P2P - API
 # =========================
-def obtener_precios_binance_p2p(logger: logging.Logger, session: requests.Session) -> List[float]:
-    payload = {
-        "page": 1,
+@dataclass(frozen=True)
+class ParP2P:
+    asset: str
+    fiat: str
+    trade_type: str
+
+    @property
+    def clave(self) -> str:
+        return f"{self.asset}/{self.fiat}/{self.trade_type}"
+
+
+def _par_configurado() -> ParP2P:
+    return ParP2P(cfg.ASSET, cfg.FIAT, cfg.TRADE_TYPE)
+
+
+def _payload_binance(page: int, par: ParP2P) -> Dict[str, Any]:
+    return {
+        "page": page,
         "rows": cfg.ROWS,
         "payTypes": [],
-        "asset": cfg.ASSET,
-        "fiat": cfg.FIAT,
-        "tradeType": cfg.TRADE_TYPE,
+        "asset": par.asset,
+        "fiat": par.fiat,
+        "tradeType": par.trade_type,
     }
 
-    logger.info(f"Obteniendo Binance P2P por API: asset={cfg.ASSET} fiat={cfg.FIAT} tradeType={cfg.TRADE_TYPE} rows={cfg.ROWS}")
-    r = request_seguro("POST", cfg.BINANCE_P2P_API_URL, logger, session, json=payload)
 
-    raw = r.text
+def _float_o_nan(valor: Any) -> float:
     try:
-        data = r.json()
-    except Exception:
-        logger.error("Binance no devolvió JSON. Guardando respuesta cruda en logs/binance_raw.txt")
-        with open("logs/binance_raw.txt", "w", encoding="utf-8") as f:
-            f.write(raw)
-        raise RuntimeError("La respuesta de Binance no es JSON (posible bloqueo o cambio del endpoint).")
-
-    ofertas = data.get("data") or []
-    if not ofertas:
-        logger.error("Binance devolvió JSON sin ofertas. Guardando en logs/binance_empty.json")
-        with open("logs/binance_empty.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        raise RuntimeError("Binance devolvió 0 ofertas (posible bloqueo/región/cambio).")
-
-    precios: List[float] = []
-    for item in ofertas:
+        return float(valor)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+@dataclass(frozen=True, slots=True)
+class AnuncioP2P:
+    """
+    Un anuncio del libro P2P con sólo los campos que usamos. Con slots no hay __dict__
+    por instancia: pesa una fracción del dict anidado que devuelve Binance.
+    """
+    numero: Optional[str]
+    precio: float
+    cantidad: float  # tradableQuantity (en el asset)
+    monto_min: float  # minSingleTransAmount (en fiat)
+    monto_max: float  # maxSingleTransAmount (en fiat)
+
+    @classmethod
+    def desde_json(cls, item: Dict[str, Any]) -> Optional["AnuncioP2P"]:
+        """None si el anuncio no trae un precio parseable."""
         adv = item.get("adv") or {}
-        price_str = adv.get("price")
-        if price_str:
+        try:
+            precio = float(adv.get("price") or "")
+        except (TypeError, ValueError):
+            return None
+        return cls(
+            adv.get("advNo"),
+            precio,
+            _float_o_nan(adv.get("tradableQuantity")),
+            _float_o_nan(adv.get("minSingleTransAmount")),
+            _float_o_nan(adv.get("maxSingleTransAmount")),
+        )
+
+    def como_fila(self) -> Tuple[Optional[str], float, float, float, float]:
+        return self.numero, self.precio, self.cantidad, self.monto_min, self.monto_max
+
+
+def _anuncios_de_pagina(logger: logging.Logger, ofertas: List[Dict[str, Any]]) -> List[AnuncioP2P]:
+    anuncios: List[AnuncioP2P] = []
+    for item in ofertas:
+        anuncio = AnuncioP2P.desde_json(item)
+        if anuncio is not None:
+            anuncios.append(anuncio)
+        elif logger.isEnabledFor(logging.DEBUG):
+            # El chequeo evita armar el argumento cuando DEBUG está apagado.
+            logger.debug("Precio no parseable (se omite): %s", (item.get("adv") or {}).get("price"))
+    return anuncios
+
+
+def _leer_json(contenido: bytes) -> Any:
+    return orjson.loads(contenido) if orjson is not None else json.loads(contenido)
+
+
+def _guardar_crudo(ruta: str, contenido: bytes) -> None:
+    with open(ruta, "wb") as f:
+        f.write(contenido)
+
+
+def _decodificar_pagina_binance(logger: logging.Logger, r: Any, primera: bool) -> List[AnuncioP2P]:
+    """
+    Decodifica la página desde los bytes (orjson si está, si no json) y se queda sólo
+    con los anuncios ya proyectados: el árbol de dicts se suelta al salir. El body
+    crudo se escribe a disco únicamente si hay que dejar un dump de error.
+    En la primera página, sin ofertas o sin precios es error; en las siguientes, fin del libro.
+    """
+    with span("parse_binance", primera=primera) as campos:
+        contenido = r.content
+        try:
+            data = _leer_json(contenido)
+        except ValueError:
+            logger.error("Binance no devolvió JSON. Guardando respuesta cruda en logs/binance_raw.txt")
+            _guardar_crudo("logs/binance_raw.txt", contenido)
+            raise RuntimeError("La respuesta de Binance no es JSON (posible bloqueo o cambio del endpoint).")
+
+        ofertas = (data.get("data") if isinstance(data, dict) else None) or []
+        if not ofertas:
+            if not primera:
+                return []
+            logger.error("Binance devolvió JSON sin ofertas. Guardando en logs/binance_empty.json")
+            _guardar_crudo("logs/binance_empty.json", contenido)
+            raise RuntimeError("Binance devolvió 0 ofertas (posible bloqueo/región/cambio).")
+
+        anuncios = _anuncios_de_pagina(logger, ofertas)
+        if primera and not anuncios:
+            logger.error("No se pudo extraer adv.price. Guardando JSON en logs/binance_badshape.json")
+            _guardar_crudo("logs/binance_badshape.json", contenido)
+            raise RuntimeError("No se pudieron parsear precios desde la respuesta de Binance.")
+        campos["anuncios"] = len(anuncios)
+        return anuncios
+
+
+async def _obtener_libro_binance_p2p(logger: logging.Logger, cliente: ClienteHTTPAsync, par: ParP2P) -> List[AnuncioP2P]:
+    """
+    Trae hasta BINANCE_PAGES páginas en paralelo (con tope por host del cliente),
+    deduplica por adv.advNo y corta apenas una página termina más allá de
+    BINANCE_DEPTH_MAX_DISTANCE_PCT del mejor precio (o viene vacía); las páginas
+    siguientes se cancelan. Devuelve el libro completo, en el orden de Binance.
+    Si falla una página posterior a la primera, se devuelve lo juntado hasta ahí.
+    """
+    async def pagina(page: int) -> List[AnuncioP2P]:
+        r = await request_seguro_async("POST", cfg.BINANCE_P2P_API_URL, logger, cliente, json=_payload_binance(page, par))
+        return _decodificar_pagina_binance(logger, r, primera=page == 1)
+
+    libro: List[AnuncioP2P] = []
+    vistos = set()
+    mejor: Optional[float] = None
+
+    tareas = [asyncio.create_task(pagina(p)) for p in range(1, cfg.BINANCE_PAGES + 1)]
+    try:
+        for page, tarea in enumerate(tareas, start=1):
+            if page == 1:
+                anuncios = await tarea
+            else:
+                try:
+                    anuncios = await tarea
+                except PresupuestoAgotado:
+                    raise
+                except Exception as e:
+                    logger.warning("Binance P2P: falló la página %d (%s); sigo con %d anuncios.", page, e, len(libro))
+                    break
+            if not anuncios:
+                logger.debug("Binance P2P: página %d vacía, fin del libro.", page)
+                break
+
+            for anuncio in anuncios:
+                if anuncio.numero is not None:
+                    if anuncio.numero in vistos:
+                        continue
+                    vistos.add(anuncio.numero)
+                libro.append(anuncio)
+
+            if mejor is None:
+                mejor = anuncios[0].precio
+            if cfg.BINANCE_DEPTH_MAX_DISTANCE_PCT > 0 and mejor:
+                distancia = abs(anuncios[-1].precio - mejor) / mejor * 100
+                if distancia > cfg.BINANCE_DEPTH_MAX_DISTANCE_PCT:
+                    logger.debug("Binance P2P: página %d a %.2f%% del mejor precio, corto acá.", page, distancia)
+                    break
+    finally:
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+    return libro
+
+
+def obtener_anuncios_binance_p2p(logger: logging.Logger, session: requests.Session) -> List[AnuncioP2P]:
+    """El libro del par configurado (una o BINANCE_PAGES páginas)."""
+    par = _par_configurado()
+    logger.info(
+        "Obteniendo Binance P2P por API: asset=%s fiat=%s tradeType=%s rows=%d pages=%d",
+        par.asset, par.fiat, par.trade_type, cfg.ROWS, cfg.BINANCE_PAGES,
+    )
+
+    if cfg.BINANCE_PAGES > 1:
+        anuncios = correr_async(lambda cliente: _obtener_libro_binance_p2p(logger, cliente, par))
+    else:
+        r = request_seguro("POST", cfg.BINANCE_P2P_API_URL, logger, session, json=_payload_binance(1, par))
+        anuncios = _decodificar_pagina_binance(logger, r, primera=True)
+
+    precios = [a.precio for a in anuncios]
+    logger.info(
+        "Precios Binance OK: cantidad=%d min=%s max=%s", len(precios), min(precios), max(precios),
+        extra=kv(par=par.clave, cantidad=len(precios), min=min(precios), max=max(precios)),
+    )
+    return anuncios
+
+
+def obtener_precios_binance_p2p(logger: logging.Logger, session: requests.Session) -> List[float]:
+    return [a.precio for a in obtener_anuncios_binance_p2p(logger, session)]
+
+
+# =========================
+# BINANCE P2P - Analítica del libro (NumPy, opcional)
+# =========================
+DTYPE_LIBRO = [("precio", "f8"), ("cantidad", "f8"), ("monto_min", "f8"), ("monto_max", "f8")]
+
+
+def libro_a_array(anuncios: List[AnuncioP2P]) -> Any:
+    """
+    Array estructurado (DTYPE_LIBRO) en el orden de Binance (mejor precio primero):
+    precio, cantidad operable del asset y montos mín/máx por operación (en fiat).
+    """
+    if np is None:
+        raise RuntimeError("La analítica del libro P2P requiere numpy (pip install numpy).")
+    return np.array([(a.precio, a.cantidad, a.monto_min, a.monto_max) for a in anuncios], dtype=DTYPE_LIBRO)
+
+
+def vwap(libro: Any) -> float:
+    cantidad = np.nan_to_num(libro["cantidad"])
+    total = cantidad.sum()
+    if total <= 0:
+        return math.nan
+    return float(np.dot(libro["precio"], cantidad) / total)
+
+
+def percentiles_precio(libro: Any, qs: Tuple[float, ...] = (10, 25, 50, 75, 90)) -> Dict[float, float]:
+    return dict(zip(qs, (float(v) for v in np.percentile(libro["precio"], qs))))
+
+
+def precio_para_monto(libro: Any, monto: float) -> Optional[float]:
+    """
+    Precio promedio efectivo para operar `monto` unidades del asset recorriendo el libro
+    en orden. Cada anuncio aporta hasta min(cantidad, monto_max / precio); el mínimo
+    por operación no se modela. None si el libro no tiene profundidad suficiente.
+    """
+    if monto <= 0 or len(libro) == 0:
+        return None
+    tope = np.where(libro["monto_max"] > 0, libro["monto_max"] / libro["precio"], np.inf)
+    disponible = np.minimum(np.nan_to_num(libro["cantidad"]), tope)
+    acumulado = np.cumsum(disponible)
+    k = int(np.searchsorted(acumulado, monto))
+    if k >= len(libro):
+        return None
+    tomado = disponible[:k + 1].copy()
+    tomado[k] = monto - (acumulado[k - 1] if k else 0.0)
+    return float(np.dot(tomado, libro["precio"][:k + 1]) / monto)
+
+
+def analizar_libro(anuncios: List[AnuncioP2P]) -> Optional[Dict[str, Any]]:
+    """VWAP, percentiles y precio para BINANCE_FILL_AMOUNT_USD; None si numpy no está instalado."""
+    if np is None:
+        return None
+    libro = libro_a_array(anuncios)
+    if len(libro) == 0:
+        return None
+    return {
+        "ofertas": len(libro),
+        "vwap": vwap(libro),
+        "percentiles": percentiles_precio(libro),
+        "precio_para_monto": precio_para_monto(libro, cfg.BINANCE_FILL_AMOUNT_USD),
+    }
+
+
+# =========================
+# BINANCE P2P - Lote (muchas combinaciones en una corrida)
+# =========================
+@dataclass(frozen=True)
+class CotizacionP2P:
+    par: ParP2P
+    low: Optional[float] = None
+    high: Optional[float] = None
+    cantidad: int = 0
+    vwap: Optional[float] = None
+    error: Optional[str] = None
+
+
+def pares_de_lote() -> List[ParP2P]:
+    return [
+        ParP2P(asset, fiat, trade_type)
+        for asset in cfg.BATCH_ASSETS
+        for fiat in cfg.BATCH_FIATS
+        for trade_type in cfg.BATCH_TRADE_TYPES
+    ]
+
+
+async def _cotizar_lote(logger: logging.Logger, cliente: ClienteHTTPAsync, pares: List[ParP2P]) -> Dict[str, CotizacionP2P]:
+    async def cotizar(par: ParP2P) -> CotizacionP2P:
+        try:
+            anuncios = await _obtener_libro_binance_p2p(logger, cliente, par)
+            precios = [a.precio for a in anuncios]
+        except PresupuestoAgotado:
+            raise
+        except Exception as e:
+            logger.warning("Lote: falló %s: %s", par.clave, e)
+            return CotizacionP2P(par, error=str(e))
+        analitica = analizar_libro(anuncios)
+        return CotizacionP2P(
+            par, low=min(precios), high=max(precios), cantidad=len(precios),
+            vwap=analitica["vwap"] if analitica else None,
+        )
+
+    # Un solo cliente (pool compartido); el tope por host de ClienteHTTPAsync limita la carga sobre Binance.
+    cotizaciones = await asyncio.gather(*(cotizar(par) for par in pares))
+    return {c.par.clave: c for c in cotizaciones}
+
+
+def cotizar_lote(logger: logging.Logger, pares: Optional[List[ParP2P]] = None) -> Dict[str, CotizacionP2P]:
+    """
+    Cotiza todas las combinaciones en paralelo sobre un único event loop.
+    Devuelve {"USDT/ARS/SELL": CotizacionP2P, ...}; una combinación que falla
+    queda con `error` y no frena al resto.
+    """
+    pares = pares if pares is not None else pares_de_lote()
+    logger.info("Cotizando lote Binance P2P: %d combinaciones, pages=%d", len(pares), cfg.BINANCE_PAGES)
+    return correr_async(lambda cliente: _cotizar_lote(logger, cliente, pares))
+
+
+# =========================
+# CACHE DE COTIZACIONES (SQLite, TTL + stale-while-revalidate)
+# =========================
+class CacheCotizaciones:
+    """
+    Cache read-through en SQLite (modo WAL, así varias corridas/procesos leen a la vez).
+    Los valores se guardan como JSON. Una conexión por thread.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._revalidando: Dict[str, threading.Thread] = {}
+
+    def _conexion(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cotizaciones ("
+                "clave TEXT PRIMARY KEY, valor TEXT NOT NULL, guardado REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def leer(self, clave: str) -> Optional[Tuple[Any, float]]:
+        """(valor, edad en segundos) o None."""
+        fila = self._conexion().execute(
+            "SELECT valor, guardado FROM cotizaciones WHERE clave = ?", (clave,)
+        ).fetchone()
+        if fila is None:
+            return None
+        return json.loads(fila[0]), time.time() - fila[1]
+
+    def escribir(self, clave: str, valor: Any) -> None:
+        self._conexion().execute(
+            "INSERT OR REPLACE INTO cotizaciones (clave, valor, guardado) VALUES (?, ?, ?)",
+            (clave, json.dumps(valor), time.time()),
+        )
+
+    def obtener(self, clave: str, ttl: float, cargar: Callable[[], Any], logger: logging.Logger) -> Any:
+        if ttl <= 0:
+            return cargar()
+
+        fuente = clave.split(":", 1)[0]
+        hit = self.leer(clave)
+        if hit is not None:
+            valor, edad = hit
+            if edad <= ttl:
+                logger.info("Cache fresco para %s (edad=%.1fs): no consulto la fuente.", clave, edad)
+                CACHE_CONSULTAS.incrementar(cache="cotizaciones", fuente=fuente, resultado="hit")
+                return valor
+            if edad <= ttl + cfg.CACHE_SWR_SECS:
+                logger.info("Cache vencido para %s (edad=%.1fs): lo uso y refresco en segundo plano.", clave, edad)
+                CACHE_CONSULTAS.incrementar(cache="cotizaciones", fuente=fuente, resultado="stale")
+                self._revalidar(clave, cargar, logger)
+                return valor
+
+        CACHE_CONSULTAS.incrementar(cache="cotizaciones", fuente=fuente, resultado="miss")
+        try:
+            valor = cargar()
+        except CircuitoAbierto as e:
+            # Con la fuente cortada, cualquier valor guardado (aun fuera del SWR) es mejor que nada.
+            if hit is None:
+                raise
+            valor, edad = hit
+            logger.warning("%s: uso el valor cacheado de %s (edad=%.0fs).", e, clave, edad)
+            CACHE_CONSULTAS.incrementar(cache="cotizaciones", fuente=fuente, resultado="circuito")
+            return valor
+        self.escribir(clave, valor)
+        return valor
+
+    def _revalidar(self, clave: str, cargar: Callable[[], Any], logger: logging.Logger) -> None:
+        def refrescar() -> None:
             try:
-                precios.append(float(price_str))
-            except ValueError:
-                logger.debug(f"Precio no parseable (se omite): {price_str}")
+                self.escribir(clave, cargar())
+                logger.debug("Cache refrescado en segundo plano: %s", clave)
+            except Exception as e:
+                logger.warning("No se pudo refrescar el cache de %s: %r", clave, e)
+            finally:
+                with self._lock:
+                    self._revalidando.pop(clave, None)
+
+        # copy_context: el refresco sigue acotado por el presupuesto de la corrida.
+        ctx = contextvars.copy_context()
+        hilo = threading.Thread(target=ctx.run, args=(refrescar,), name=f"revalidar-{clave}")
+        with self._lock:
+            if clave in self._revalidando:
+                return
+            self._revalidando[clave] = hilo
+        hilo.start()
+
+    def esperar_refrescos(self, timeout: Optional[float] = None) -> bool:
+        """
+        Espera (hasta `timeout` en total) los refrescos en segundo plano. Quien cierra
+        el loop async tiene que llamarlo antes; si no, el refresco se cancela a mitad.
+        True si no quedó ninguno corriendo.
+        """
+        limite = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            hilos = list(self._revalidando.values())
+        for hilo in hilos:
+            hilo.join(None if limite is None else max(0.0, limite - time.monotonic()))
+        with self._lock:
+            return not self._revalidando
+
+
+_cache_cotizaciones: Optional[CacheCotizaciones] = None
+
+
+def cache_cotizaciones() -> CacheCotizaciones:
+    global _cache_cotizaciones
+    if _cache_cotizaciones is None:
+        _cache_cotizaciones = CacheCotizaciones(_ruta_estado("cotizaciones.sqlite3"))
+    return _cache_cotizaciones
+
+
+def obtener_dolar_blue_cacheado(logger: logging.Logger, session: requests.Session) -> Tuple[float, float]:
+    compra, venta = cache_cotizaciones().obtener(
+        "dolarhoy:blue", cfg.CACHE_TTL_DOLARHOY_SECS, lambda: obtener_dolar_blue(logger, session), logger
+    )
+    return compra, venta
 
-    if not precios:
-        logger.error("No se pudo extraer adv.price. Guardando JSON en logs/binance_badshape.json")
-        with open("logs/binance_badshape.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        raise RuntimeError("No se pudieron parsear precios desde la respuesta de Binance.")
 
-    logger.info(f"Precios Binance OK: cantidad={len(precios)} min={min(precios)} max={max(precios)}")
-    return precios
+def obtener_anuncios_binance_p2p_cacheado(logger: logging.Logger, session: requests.Session) -> List[AnuncioP2P]:
+    clave = f"binance-anuncios:{_par_configurado().clave}:rows={cfg.ROWS}:pages={cfg.BINANCE_PAGES}"
+    filas = cache_cotizaciones().obtener(
+        clave,
+        cfg.CACHE_TTL_BINANCE_SECS,
+        lambda: [a.como_fila() for a in obtener_anuncios_binance_p2p(logger, session)],
+        logger,
+    )
+    return [AnuncioP2P(*fila) for fila in filas]
 
 
 # =========================
@@ -262,12 +2299,13 @@ def calcular_cotizacion_final(binance_low: float) -> int:
     return math.floor(binance_low * cfg.RDA_COMMISSION)
 
 
-def enviar_a_form(logger: logging.Logger, valores: dict) -> None:
+def enviar_a_form(logger: logging.Logger, valores: dict, session: Optional[requests.Session] = None) -> None:
     """
     Publica los valores en el Google Form vinculado a la Sheet.
     Espera claves:
       blue_compra, blue_venta, binance_low, valor_real,
       cotizacion_final, comision_aplicada
+    Levanta excepción si el Form no responde 200 (para que el que llama reintente).
     """
     payload = {}
     for clave, entry_id in FORM_FIELDS.items():
@@ -277,31 +2315,520 @@ def enviar_a_form(logger: logging.Logger, valores: dict) -> None:
         logger.debug("Payload de Google Form vacío; no se envía nada.")
         return
 
-    r = requests.post(FORM_URL, data=payload, timeout=10)
+    # El replay del outbox manda miles de filas en paralelo: también pasa por el token bucket del host.
+    espera = _espera_limite(urlsplit(FORM_URL).netloc)
+    if espera > 0:
+        time.sleep(espera)
+
+    post = session.post if session is not None else requests.post
+    with span("publicar_form") as campos:
+        r = post(FORM_URL, data=payload, timeout=_timeouts_intento("publicar en Google Form", 10))
+        _medir_respuesta(campos, r)
     if r.status_code != 200:
-        logger.warning(f"Google Form devolvió status {r.status_code}: {r.text[:200]}")
-    else:
-        logger.info("Valores publicados en Google Form/Sheet correctamente.")
+        raise RuntimeError(f"Google Form devolvió status {r.status_code}: {r.text[:200]}")
+    logger.info("Valores publicados en Google Form/Sheet correctamente.")
+
+
+# =========================
+# PUBLICACIÓN EN SEGUNDO PLANO
+# =========================
+class OutboxForm:
+    """
+    Outbox durable de publicaciones (SQLite, modo WAL, una conexión por thread).
+    Cada fila tiene una clave de idempotencia: encolar dos veces lo mismo no la duplica,
+    y una fila marcada como enviada no se vuelve a mandar. Las filas se toman con una
+    reserva con vencimiento, así dos procesos (serve + una corrida manual) no mandan
+    la misma fila a la vez, y si uno muere a mitad la fila vuelve a estar disponible.
+    Es tan durable como STATE_DIR: en GitHub Actions el workflow lo guarda y restaura
+    entre jobs con el cache de Actions.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+
+    def _conexion(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "clave TEXT PRIMARY KEY, valores TEXT NOT NULL, creado REAL NOT NULL, "
+                "intentos INTEGER NOT NULL DEFAULT 0, ultimo_intento REAL NOT NULL DEFAULT 0, "
+                "reservado_hasta REAL NOT NULL DEFAULT 0, ultimo_error TEXT, enviado REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_pendientes ON outbox (enviado, creado)")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def clave_para(valores: dict) -> str:
+        """Misma fila en el mismo minuto -> misma clave (serve y una corrida manual no duplican)."""
+        contenido = json.dumps(valores, sort_keys=True, ensure_ascii=False)
+        return f"{datetime.now():%Y%m%d%H%M}-{hashlib.sha1(contenido.encode('utf-8')).hexdigest()[:16]}"
+
+    def agregar(self, clave: str, valores: dict) -> bool:
+        cur = self._conexion().execute(
+            "INSERT OR IGNORE INTO outbox (clave, valores, creado) VALUES (?, ?, ?)",
+            (clave, json.dumps(valores, ensure_ascii=False), time.time()),
+        )
+        return cur.rowcount == 1
+
+    def agregar_muchas(self, filas: List[Tuple[str, dict]]) -> None:
+        conn = self._conexion()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox (clave, valores, creado) VALUES (?, ?, ?)",
+                [(clave, json.dumps(valores, ensure_ascii=False), ahora) for clave, valores in filas],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def reservar(self, limite: int, intentadas_antes_de: float) -> List[Tuple[str, dict]]:
+        """
+        Toma hasta `limite` filas pendientes (las más viejas primero) que no estén reservadas
+        y que no se hayan intentado desde `intentadas_antes_de` (una vez por pasada).
+        """
+        conn = self._conexion()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            filas = conn.execute(
+                "SELECT clave, valores FROM outbox WHERE enviado IS NULL AND reservado_hasta < ? "
+                "AND ultimo_intento < ? ORDER BY creado LIMIT ?",
+                (ahora, intentadas_antes_de, limite),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET reservado_hasta = ? WHERE clave = ?",
+                [(ahora + cfg.FORM_OUTBOX_LEASE_SECS, clave) for clave, _ in filas],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return [(clave, json.loads(valores)) for clave, valores in filas]
+
+    def marcar(self, enviadas: List[str], fallidas: List[Tuple[str, str]]) -> None:
+        conn = self._conexion()
+        ahora = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "UPDATE outbox SET enviado = ?, intentos = intentos + 1, ultimo_intento = ?, "
+                "reservado_hasta = 0, ultimo_error = NULL WHERE clave = ?",
+                [(ahora, ahora, clave) for clave in enviadas],
+            )
+            conn.executemany(
+                "UPDATE outbox SET intentos = intentos + 1, ultimo_intento = ?, reservado_hasta = 0, "
+                "ultimo_error = ? WHERE clave = ?",
+                [(ahora, error, clave) for clave, error in fallidas],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def pendientes(self) -> int:
+        return self._conexion().execute("SELECT COUNT(*) FROM outbox WHERE enviado IS NULL").fetchone()[0]
+
+    def limpiar(self, dias: float) -> int:
+        cur = self._conexion().execute(
+            "DELETE FROM outbox WHERE enviado IS NOT NULL AND enviado < ?", (time.time() - dias * 86400,)
+        )
+        return cur.rowcount
+
+
+class PublicadorForm:
+    """
+    Worker de fondo para el Google Form: el ciclo deja la fila en el outbox y sigue
+    sin esperar al Form. El worker manda todo lo pendiente (lo de esta corrida y lo que
+    quedó de corridas anteriores) en bloques, con FORM_REPLAY_CONCURRENCY envíos en
+    paralelo sobre una sesión propia con pool. Lo que falla se reintenta con backoff +
+    jitter hasta FORM_RETRIES pasadas; después queda en el outbox para la próxima.
+    Los envíos no cuentan contra el presupuesto de la corrida (el worker no lo hereda).
+    Cada drenaje con filas deja su propio registro NDJSON (modo "publicar") con los
+    spans de los POST, bajo el run_id de la corrida que encoló la última fila.
+    """
+
+    def __init__(self, logger: logging.Logger, outbox: Optional[OutboxForm] = None):
+        self.logger = logger
+        self.outbox = outbox or OutboxForm(_ruta_estado("outbox_form.sqlite3"))
+        self.outbox.limpiar(cfg.FORM_OUTBOX_RETENTION_DAYS)
+
+        concurrencia = max(1, cfg.FORM_REPLAY_CONCURRENCY)
+        self._session = crear_sesion()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrencia)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._pool = ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix="publicador-form")
+
+        self._run_id_origen: Optional[str] = None
+        self._hay_trabajo = threading.Event()
+        self._parar = threading.Event()
+        # Arranca drenando: lo que haya quedado de corridas anteriores sale primero.
+        self._hay_trabajo.set()
+        self._thread = threading.Thread(target=self._trabajar, name="publicador-form", daemon=True)
+        self._thread.start()
+
+    def encolar(self, valores: dict) -> bool:
+        """Deja la fila en el outbox y despierta al worker. False si ya estaba (misma clave)."""
+        nueva = self.outbox.agregar(OutboxForm.clave_para(valores), valores)
+        self._run_id_origen = run_id_actual()
+        if not nueva:
+            self.logger.info("La fila ya estaba en el outbox (misma clave de idempotencia): no se duplica.")
+        self._hay_trabajo.set()
+        return nueva
+
+    def _trabajar(self) -> None:
+        while True:
+            self._hay_trabajo.wait()
+            self._hay_trabajo.clear()
+            token = _run_id.set(self._run_id_origen)
+            try:
+                if self.outbox.pendientes():
+                    with metricas_de_corrida(self.logger, "publicar") as metricas:
+                        metricas.rc = 1 if self._drenar() else 0
+                else:
+                    OUTBOX_PENDIENTES.fijar(0)
+            except Exception:
+                self.logger.exception("Error drenando el outbox del Google Form.")
+            finally:
+                _run_id.reset(token)
+            if self._parar.is_set():
+                return
+
+    def _enviar(self, fila: Tuple[str, dict]) -> Tuple[str, Optional[str]]:
+        clave, valores = fila
+        try:
+            enviar_a_form(self.logger, valores, self._session)
+            return clave, None
+        except Exception as e:
+            return clave, str(e)[:500]
+
+    def _pasada(self) -> Tuple[int, int]:
+        """Intenta cada fila pendiente una vez. Devuelve (enviadas, fallidas)."""
+        inicio, t0 = time.time(), time.perf_counter()
+        enviadas = fallidas = 0
+        while True:
+            filas = self.outbox.reservar(cfg.FORM_REPLAY_BATCH, inicio)
+            if not filas:
+                break
+            # copy_context: los spans de cada POST van a las métricas del drenaje en curso.
+            envios = [self._pool.submit(contextvars.copy_context().run, self._enviar, fila) for fila in filas]
+            resultados = [envio.result() for envio in envios]
+            ok = [clave for clave, error in resultados if error is None]
+            mal = [(clave, error) for clave, error in resultados if error is not None]
+            self.outbox.marcar(ok, mal)
+            enviadas, fallidas = enviadas + len(ok), fallidas + len(mal)
+            OUTBOX_ENVIOS.incrementar(len(ok), resultado="ok")
+            OUTBOX_ENVIOS.incrementar(len(mal), resultado="error")
+            for clave, error in mal[:3]:
+                self.logger.warning("No se pudo enviar al Google Form (%s): %s", clave, error)
+
+        duracion = time.perf_counter() - t0
+        if enviadas + fallidas > 1:
+            self.logger.info(
+                "Outbox: %d enviada(s), %d fallida(s) en %.2fs (%.0f filas/s)",
+                enviadas, fallidas, duracion, enviadas / duracion if duracion > 0 else 0,
+                extra=kv(enviadas=enviadas, fallidas=fallidas, segundos=round(duracion, 3)),
+            )
+        return enviadas, fallidas
+
+    def _drenar(self) -> int:
+        """Hasta FORM_RETRIES pasadas; devuelve cuántas filas quedaron pendientes."""
+        for pasada in range(1, cfg.FORM_RETRIES + 1):
+            _, fallidas = self._pasada()
+            if not fallidas:
+                break
+            if pasada < cfg.FORM_RETRIES:
+                time.sleep(_espera_backoff(pasada))
+        pendientes = self.outbox.pendientes()
+        OUTBOX_PENDIENTES.fijar(pendientes)
+        if pendientes:
+            self.logger.warning("Outbox: quedan %d fila(s) sin publicar; se reintentan en la próxima corrida.", pendientes)
+        return pendientes
+
+    def pendientes(self) -> int:
+        return self.outbox.pendientes()
+
+    def cerrar(self, timeout: Optional[float] = None) -> bool:
+        """Termina de drenar (hasta `timeout`). True si el worker terminó; lo pendiente queda en el outbox."""
+        self._parar.set()
+        self._hay_trabajo.set()
+        self._thread.join(timeout)
+        drenado = not self._thread.is_alive()
+        if not drenado:
+            self.logger.warning("El publicador no terminó de drenar en %ss: lo pendiente queda en el outbox.", timeout)
+        self._pool.shutdown(wait=drenado)
+        self._session.close()
+        return drenado
+
+
+_publicador: Optional[PublicadorForm] = None
+_lock_publicador = threading.Lock()
+
+
+def publicador_form(logger: logging.Logger) -> PublicadorForm:
+    global _publicador
+    with _lock_publicador:
+        if _publicador is None:
+            _publicador = PublicadorForm(logger)
+        return _publicador
+
+
+def cerrar_publicador() -> None:
+    global _publicador
+    with _lock_publicador:
+        if _publicador is None:
+            return
+        _publicador.cerrar(cfg.FORM_DRAIN_TIMEOUT_SECS)
+        _publicador = None
+
+
+# =========================
+# HISTORIAL (registros de ancho fijo, append-only)
+# =========================
+@dataclass(frozen=True)
+class RegistroCotizacion:
+    timestamp: float  # epoch UTC
+    blue_compra: float
+    blue_venta: float
+    binance_low: float
+    binance_high: float
+    valor_real: float
+    cotizacion_final: int
+    comision: float
+
+
+class HistorialCotizaciones:
+    """
+    Archivo binario: un header de 16 bytes y después registros de 64 bytes
+    (7 float64 + 1 int64, little endian) en orden de llegada. Como el ancho es fijo,
+    el último registro se lee con un seek (O(1)) y la búsqueda por timestamp es
+    binaria sobre un mmap. Se asume que los timestamps se agregan en orden creciente.
+    Un registro final incompleto (corte a mitad de escritura) se ignora al leer y
+    se recorta antes de agregar, para que los siguientes queden alineados.
+    """
+
+    MAGIC = b"COTH"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHH8x")
+    REGISTRO = struct.Struct("<ddddddqd")
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        if not os.path.exists(ruta) or os.path.getsize(ruta) == 0:
+            with open(ruta, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.REGISTRO.size))
+        else:
+            with open(ruta, "rb") as f:
+                magic, version, tam = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION or tam != self.REGISTRO.size:
+                raise ValueError(f"{ruta} no es un historial compatible (magic={magic!r} v={version} tam={tam}).")
+            with open(ruta, "ab") as f:
+                self._recortar_cola(f)
+
+    def _recortar_cola(self, f: Any) -> None:
+        """Descarta los bytes de un registro final incompleto (f abierto en modo append)."""
+        tam = f.seek(0, os.SEEK_END)
+        if (tam - self.HEADER.size) % self.REGISTRO.size:
+            f.truncate(self.HEADER.size + (tam - self.HEADER.size) // self.REGISTRO.size * self.REGISTRO.size)
+
+    def __len__(self) -> int:
+        return max(0, os.path.getsize(self.ruta) - self.HEADER.size) // self.REGISTRO.size
+
+    def _desempaquetar(self, buf: Any, offset: int = 0) -> RegistroCotizacion:
+        return RegistroCotizacion(*self.REGISTRO.unpack_from(buf, offset))
+
+    def agregar(self, r: RegistroCotizacion) -> None:
+        datos = self.REGISTRO.pack(
+            r.timestamp, r.blue_compra, r.blue_venta, r.binance_low, r.binance_high,
+            r.valor_real, int(r.cotizacion_final), r.comision,
+        )
+        with self._lock, open(self.ruta, "ab") as f:
+            self._recortar_cola(f)
+            # Con O_APPEND cada write de 64 bytes cae entero al final, aunque escriban varios procesos.
+            f.write(datos)
+
+    def ultimo(self) -> Optional[RegistroCotizacion]:
+        n = len(self)
+        if n == 0:
+            return None
+        with open(self.ruta, "rb") as f:
+            f.seek(self.HEADER.size + (n - 1) * self.REGISTRO.size)
+            return self._desempaquetar(f.read(self.REGISTRO.size))
+
+    def rango(self, desde: float = float("-inf"), hasta: float = float("inf")) -> List[RegistroCotizacion]:
+        """Registros con desde <= timestamp < hasta (búsqueda binaria sobre el mmap)."""
+        n = len(self)
+        if n == 0:
+            return []
+        with open(self.ruta, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            base, tam = self.HEADER.size, self.REGISTRO.size
+            clave = lambda i: struct.unpack_from("<d", mm, base + i * tam)[0]
+            inicio = bisect.bisect_left(range(n), desde, key=clave)
+            fin = bisect.bisect_left(range(n), hasta, lo=inicio, key=clave)
+            return [self._desempaquetar(mm, base + i * tam) for i in range(inicio, fin)]
+
+
+_historial: Optional[HistorialCotizaciones] = None
+
+
+def historial_cotizaciones() -> HistorialCotizaciones:
+    global _historial
+    if _historial is None:
+        _historial = HistorialCotizaciones(_ruta_estado("historial.bin"))
+    return _historial
+
+
+# =========================
+# PIPELINE (etapas con dependencias)
+# =========================
+@dataclass(frozen=True)
+class Etapa:
+    nombre: str
+    funcion: Callable[..., Any]
+    dependencias: Tuple[str, ...] = ()
+
+
+def ejecutar_pipeline(etapas: List[Etapa], logger: logging.Logger) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Corre las etapas como un DAG: cada una arranca apenas están los resultados
+    de sus dependencias (que recibe como kwargs), y las independientes corren en paralelo.
+    Devuelve (resultados, segundos por etapa). Si una etapa falla, se propaga su excepción.
+    """
+    por_nombre = {e.nombre: e for e in etapas}
+    for e in etapas:
+        faltantes = [d for d in e.dependencias if d not in por_nombre]
+        if faltantes:
+            raise ValueError(f"La etapa '{e.nombre}' depende de etapas inexistentes: {faltantes}")
+
+    resultados: Dict[str, Any] = {}
+    tiempos: Dict[str, float] = {}
+    pendientes = list(etapas)
+
+    def correr(etapa: Etapa) -> Any:
+        t0 = time.perf_counter()
+        try:
+            return etapa.funcion(**{d: resultados[d] for d in etapa.dependencias})
+        finally:
+            tiempos[etapa.nombre] = time.perf_counter() - t0
+
+    presupuesto = _presupuesto_actual.get()
+    pool = ThreadPoolExecutor(max_workers=max(1, len(etapas)), thread_name_prefix="etapa")
+    try:
+        en_curso: Dict[Any, Etapa] = {}
+        while pendientes or en_curso:
+            listas = [e for e in pendientes if all(d in resultados for d in e.dependencias)]
+            for e in listas:
+                pendientes.remove(e)
+                if presupuesto is not None:
+                    presupuesto.verificar(f"etapa '{e.nombre}'")
+                logger.debug("Etapa '%s' iniciada.", e.nombre)
+                # copy_context: la etapa ve el mismo presupuesto que quien corre el pipeline.
+                en_curso[pool.submit(contextvars.copy_context().run, correr, e)] = e
+
+            if not en_curso:
+                raise ValueError(f"Dependencias cíclicas entre etapas: {[e.nombre for e in pendientes]}")
+
+            espera = max(0.0, presupuesto.restante()) if presupuesto is not None else None
+            hechos, _ = wait(en_curso, timeout=espera, return_when=FIRST_COMPLETED)
+            if not hechos:
+                presupuesto.verificar(f"terminar etapas {[e.nombre for e in en_curso.values()]}")
+            for fut in hechos:
+                e = en_curso.pop(fut)
+                try:
+                    resultados[e.nombre] = fut.result()
+                except Exception:
+                    logger.error("Etapa '%s' falló luego de %.3fs.", e.nombre, tiempos.get(e.nombre, 0.0))
+                    raise
+                logger.debug("Etapa '%s' terminada en %.3fs.", e.nombre, tiempos[e.nombre])
+    finally:
+        # No esperamos a etapas colgadas: sus timeouts ya están acotados por el presupuesto.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # En el orden declarado, no en el de finalización.
+    return resultados, {e.nombre: tiempos[e.nombre] for e in etapas if e.nombre in tiempos}
+
+
+def _formatear_tiempos(tiempos: Dict[str, float]) -> str:
+    return ",".join(f"{nombre}:{seg:.3f}s" for nombre, seg in tiempos.items())
 
 
 # =========================
 # MAIN
 # =========================
-def main() -> int:
-    logger = configurar_logger()
-    session = crear_sesion()
+def ejecutar_ciclo(
+    logger: logging.Logger,
+    session: requests.Session,
+    tiempos_etapas: Optional[Dict[str, float]] = None,
+) -> int:
+    """
+    Un ciclo completo: fetch -> cálculos -> salida -> publicación. Devuelve el exit code.
+    Deja un registro en METRICS_NDJSON. Si se pasa `tiempos_etapas`, se completa con la
+    duración de cada etapa (lo usa el bench).
+    """
+    with metricas_de_corrida(logger, "run") as metricas:
+        metricas.rc = _ejecutar_ciclo(logger, session, metricas.etapas)
+    if tiempos_etapas is not None:
+        tiempos_etapas.update(metricas.etapas)
+    return metricas.rc
 
-    logger.info("Iniciando ejecución...")
-    logger.info(f"Configuración: comisión={cfg.RDA_COMMISSION} ONLY_PAYO={cfg.ONLY_PAYO} PUBLICAR_FOROS={cfg.PUBLISH_COTIZATIONS}")
 
-    blue_compra, blue_venta = obtener_dolar_blue(logger, session)
+def _ejecutar_ciclo(logger: logging.Logger, session: requests.Session, tiempos_etapas: Dict[str, float]) -> int:
+    logger.info("Iniciando ejecución...")
+    logger.info(
+        "Configuración: comisión=%s ONLY_PAYO=%s PUBLICAR_FOROS=%s",
+        cfg.RDA_COMMISSION, cfg.ONLY_PAYO, cfg.PUBLISH_COTIZATIONS,
+    )
 
-    precios = obtener_precios_binance_p2p(logger, session)
-    binance_low = min(precios)
-    binance_high = max(precios)
+    def publicar(blue: Tuple[float, float], precios: List[float], valor_real: float, cotizacion_final: int) -> None:
+        # Sólo deja la fila en el outbox: el envío (con reintentos) lo hace el PublicadorForm en segundo plano.
+        publicador_form(logger).encolar({
+            "blue_compra": _formatear_pesos(blue[0]),
+            "blue_venta": _formatear_pesos(blue[1]),
+            "binance_low": f"{min(precios)}",
+            "valor_real": _formatear_pesos(valor_real),
+            "cotizacion_final": f"{cotizacion_final}",
+            "comision_aplicada": f"{cfg.RDA_COMMISSION}",
+        })
 
-    valor_real = calcular_valor_real_wise_payo(binance_low, binance_high)
-    cotizacion_final = calcular_cotizacion_final(binance_low)
+    # Dolarhoy y Binance no dependen entre sí: corren en paralelo.
+    etapas = [
+        Etapa("blue", lambda: obtener_dolar_blue_cacheado(logger, session)),
+        Etapa("binance", lambda: obtener_anuncios_binance_p2p_cacheado(logger, session)),
+        Etapa("precios", lambda binance: [a.precio for a in binance], ("binance",)),
+        Etapa("libro", lambda binance: analizar_libro(binance), ("binance",)),
+        Etapa("valor_real", lambda precios: calcular_valor_real_wise_payo(min(precios), max(precios)), ("precios",)),
+        Etapa("cotizacion_final", lambda precios: calcular_cotizacion_final(min(precios)), ("precios",)),
+        Etapa("publicar", publicar, ("blue", "precios", "valor_real", "cotizacion_final")),
+    ]
+
+    t0 = time.perf_counter()
+    try:
+        with presupuesto_de_ejecucion(cfg.RUN_DEADLINE_SECS):
+            resultados, tiempos = ejecutar_pipeline(etapas, logger)
+    except PresupuestoAgotado as e:
+        logger.error("Corrida abortada por tiempo: %s", e)
+        return 1
+    except CircuitoAbierto as e:
+        logger.error("Corrida abortada: %s (y sin cotización cacheada para reemplazarla).", e)
+        return 1
+    total = time.perf_counter() - t0
+    tiempos_etapas.update(tiempos)
+
+    blue_compra, blue_venta = resultados["blue"]
+    binance_low = min(resultados["precios"])
+    binance_high = max(resultados["precios"])
+    valor_real = resultados["valor_real"]
+    cotizacion_final = resultados["cotizacion_final"]
 
     # OUTPUT (como pediste)
     print("")
@@ -314,29 +2841,724 @@ def main() -> int:
 
     logger.info("Salida generada correctamente.")
     logger.info(
-        "Resumen -> "
-        f"blue_compra={_formatear_pesos(blue_compra)} | "
-        f"blue_venta={_formatear_pesos(blue_venta)} | "
-        f"binance_low={binance_low} | "
-        f"valor_real={valor_real} | "
-        f"cotizacion_final={cotizacion_final}"
+        "Resumen -> blue_compra=%s | blue_venta=%s | binance_low=%s | valor_real=%s | "
+        "cotizacion_final=%s | tiempos=%s | total=%.3fs",
+        _formatear_pesos(blue_compra), _formatear_pesos(blue_venta), binance_low, valor_real,
+        cotizacion_final, _formatear_tiempos(tiempos), total,
+        extra=kv(
+            blue_compra=blue_compra, blue_venta=blue_venta, binance_low=binance_low, valor_real=valor_real,
+            cotizacion_final=cotizacion_final, total=round(total, 3),
+        ),
     )
 
-    try:
-        enviar_a_form(logger, {
-            "blue_compra": _formatear_pesos(blue_compra),
-            "blue_venta": _formatear_pesos(blue_venta),
-            "binance_low": f"{binance_low}",
-            "valor_real": _formatear_pesos(valor_real),
-            "cotizacion_final": f"{cotizacion_final}",
-            "comision_aplicada": f"{cfg.RDA_COMMISSION}",
-        })
-    except Exception as e:
-        logger.warning(f"No se pudo enviar al Google Form: {e}")
+    libro = resultados["libro"]
+    if libro is not None:
+        percentiles = " ".join(f"p{q:g}={v:.2f}" for q, v in libro["percentiles"].items())
+        logger.info(
+            "Libro Binance -> ofertas=%d | vwap=%.2f | %s | precio_para_%g=%s",
+            libro["ofertas"], libro["vwap"], percentiles, cfg.BINANCE_FILL_AMOUNT_USD, libro["precio_para_monto"],
+        )
+
+    COTIZACION.fijar(cotizacion_final, serie="cotizacion_final")
+    COTIZACION.fijar(binance_low, serie="binance_low")
+    COTIZACION.fijar(blue_compra, serie="blue_compra")
+    COTIZACION.fijar(blue_venta, serie="blue_venta")
+    ULTIMA_CORRIDA_OK.fijar(time.time())
+
+    if cfg.HISTORY_ENABLED:
+        try:
+            historial_cotizaciones().agregar(RegistroCotizacion(
+                time.time(), blue_compra, blue_venta, binance_low, binance_high,
+                valor_real, cotizacion_final, cfg.RDA_COMMISSION,
+            ))
+        except Exception as e:
+            logger.warning("No se pudo guardar en el historial: %s", e)
 
     logger.info("Ejecución finalizada OK.")
     return 0
 
 
+def main() -> int:
+    logger = configurar_logger()
+    session = crear_sesion()
+    try:
+        return ejecutar_ciclo(logger, session)
+    finally:
+        # Antes de cancelar lo pendiente en el loop: el refresco SWR también lo usa.
+        esperar_refrescos_cache()
+        cerrar_async()
+        cerrar_publicador()
+        session.close()
+
+
+def main_lote() -> int:
+    logger = configurar_logger()
+
+    t0 = time.perf_counter()
+    with metricas_de_corrida(logger, "lote") as metricas:
+        try:
+            with presupuesto_de_ejecucion(cfg.RUN_DEADLINE_SECS):
+                resultados = cotizar_lote(logger)
+        except PresupuestoAgotado as e:
+            logger.error("Lote abortado por tiempo: %s", e)
+            metricas.rc = 1
+            return 1
+        metricas.rc = 0 if any(not c.error for c in resultados.values()) else 1
+    total = time.perf_counter() - t0
+
+    print("")
+    for clave, c in resultados.items():
+        if c.error:
+            print(f"{clave:<16} ERROR: {c.error}")
+        else:
+            print(f"{clave:<16} low={c.low} high={c.high} vwap={c.vwap} ofertas={c.cantidad}")
+    print("")
+
+    ok = sum(1 for c in resultados.values() if not c.error)
+    logger.info("Resumen lote -> ok=%d/%d | total=%.3fs", ok, len(resultados), total)
+    return 0 if ok else 1
+
+
+def _parsear_fecha(texto: Optional[str], default: float) -> float:
+    return datetime.fromisoformat(texto).timestamp() if texto else default
+
+
+def main_historial(desde: Optional[str], hasta: Optional[str], solo_ultimo: bool) -> int:
+    historial = historial_cotizaciones()
+    if solo_ultimo:
+        ultimo = historial.ultimo()
+        registros = [ultimo] if ultimo is not None else []
+    else:
+        registros = historial.rango(_parsear_fecha(desde, float("-inf")), _parsear_fecha(hasta, float("inf")))
+
+    for r in registros:
+        print(
+            f"{datetime.fromtimestamp(r.timestamp):%Y-%m-%d %H:%M:%S} | "
+            f"blue={_formatear_pesos(r.blue_compra)}/{_formatear_pesos(r.blue_venta)} | "
+            f"binance={r.binance_low}/{r.binance_high} | valor_real={r.valor_real} | "
+            f"cotizacion_final={r.cotizacion_final} | comision={r.comision}"
+        )
+    print(f"{len(registros)} registro(s) de {len(historial)}.")
+    return 0
+
+
+# =========================
+# MODO SERVE (daemon con scheduler propio)
+# =========================
+def _parsear_campo_cron(campo: str, minimo: int, maximo: int) -> Set[int]:
+    valores: Set[int] = set()
+    for parte in campo.split(","):
+        rango, _, paso_str = parte.partition("/")
+        paso = int(paso_str) if paso_str else 1
+        if rango == "*":
+            desde, hasta = minimo, maximo
+        elif "-" in rango:
+            desde, hasta = (int(x) for x in rango.split("-", 1))
+        else:
+            desde = int(rango)
+            hasta = maximo if paso_str else desde
+        if desde < minimo or hasta > maximo or desde > hasta or paso < 1:
+            raise ValueError(f"Campo cron fuera de rango: {campo!r} ({minimo}-{maximo})")
+        valores.update(range(desde, hasta + 1, paso))
+    return valores
+
+
+class Cron:
+    """Expresión cron de 5 campos (minuto hora día mes día-semana) con *, listas, rangos y pasos."""
+
+    def __init__(self, expresion: str):
+        campos = expresion.split()
+        if len(campos) != 5:
+            raise ValueError(f"Cron inválido (se esperan 5 campos): {expresion!r}")
+        self.expresion = expresion
+        self.minutos = _parsear_campo_cron(campos[0], 0, 59)
+        self.horas = _parsear_campo_cron(campos[1], 0, 23)
+        self.dias = _parsear_campo_cron(campos[2], 1, 31)
+        self.meses = _parsear_campo_cron(campos[3], 1, 12)
+        # 0 y 7 son domingo, como en cron.
+        self.dias_semana = {d % 7 for d in _parsear_campo_cron(campos[4], 0, 7)}
+        self._dia_libre = campos[2] == "*"
+        self._dia_semana_libre = campos[4] == "*"
+
+    def _dia_ok(self, t: datetime) -> bool:
+        por_dia = t.day in self.dias
+        por_semana = (t.weekday() + 1) % 7 in self.dias_semana
+        # Si se restringen ambos, alcanza con cualquiera de los dos (semántica de cron).
+        if not self._dia_libre and not self._dia_semana_libre:
+            return por_dia or por_semana
+        return por_dia and por_semana
+
+    def siguiente(self, desde: datetime) -> datetime:
+        """Primer disparo estrictamente posterior a `desde`."""
+        t = desde.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limite = t + timedelta(days=366 * 5)
+        while t < limite:
+            if t.month not in self.meses:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._dia_ok(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.horas:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutos:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"El cron {self.expresion!r} nunca dispara.")
+
+
+def main_serve(expresion_cron: str, puerto_metricas: int = 0) -> int:
+    """
+    Proceso de larga vida: reusa logger, sesión HTTP, loop async y caches, y corre un
+    ciclo en cada disparo del cron. Los disparos se calculan contra el reloj (no con
+    sleep(intervalo)), así el atraso no se acumula; si un ciclo se pasa del siguiente
+    disparo, los perdidos se saltean. SIGINT/SIGTERM cortan entre ciclos.
+    Con `puerto_metricas` expone GET /metrics (formato Prometheus) mientras corre.
+    """
+    logger = configurar_logger()
+    session = crear_sesion()
+    cron = Cron(expresion_cron)
+    servidor_metricas = iniciar_servidor_metricas(logger, puerto_metricas)
+
+    parar = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: parar.set())
+
+    proximo = cron.siguiente(datetime.now())
+    logger.info("Modo serve iniciado. cron='%s' próximo=%s", cron.expresion, f"{proximo:%Y-%m-%d %H:%M}")
+
+    ciclos = 0
+    while not parar.is_set():
+        # Se recalcula lo que falta en cada despertar: tolera saltos de reloj y wakeups tempranos.
+        falta = (proximo - datetime.now()).total_seconds()
+        if falta > 0:
+            parar.wait(min(falta, 30.0))
+            continue
+
+        ciclos += 1
+        logger.info("Ciclo %d (disparo %s, atraso=%.2fs)", ciclos, f"{proximo:%H:%M}", -falta)
+        token = _run_id.set(nuevo_run_id())
+        try:
+            ejecutar_ciclo(logger, session)
+        except Exception:
+            logger.exception("Ciclo %d falló.", ciclos)
+        finally:
+            _run_id.reset(token)
+
+        ahora = datetime.now()
+        proximo, saltados = cron.siguiente(proximo), 0
+        while proximo <= ahora:
+            proximo, saltados = cron.siguiente(proximo), saltados + 1
+        if saltados:
+            logger.warning("El ciclo se pasó del horario: se saltean %d disparo(s).", saltados)
+
+    logger.info("Modo serve detenido luego de %d ciclo(s).", ciclos)
+    if servidor_metricas is not None:
+        servidor_metricas.shutdown()
+        servidor_metricas.server_close()
+    cerrar_publicador()
+    esperar_refrescos_cache()
+    cerrar_async()
+    session.close()
+    return 0
+
+
+# =========================
+# BENCHMARKS
+# =========================
+def _extraer_compra_venta_legacy(contenido: bytes) -> Optional[Tuple[float, float]]:
+    """
+    El parser anterior (decode + lower + dos regex por llamada), sólo para comparar.
+    Ancla en el último cotizacion_moneda: con más de un bloque difiere de los actuales.
+    """
+    html = contenido.decode("utf-8", "replace")
+    patron_compra = re.compile(
+        r'<div\s+class="topic">\s*Compra\s*</div>\s*<div\s+class="value">\s*\$?\s*([0-9\.,]+)\s*</div>',
+        re.IGNORECASE | re.DOTALL
+    )
+    patron_venta = re.compile(
+        r'<div\s+class="topic">\s*Venta\s*</div>\s*<div\s+class="value">\s*\$?\s*([0-9\.,]+)\s*</div>',
+        re.IGNORECASE | re.DOTALL
+    )
+    idx = html.lower().rfind("cotizacion_moneda")
+    ventana = html[idx:] if idx != -1 else html
+    m_c = patron_compra.search(ventana) or patron_compra.search(html)
+    m_v = patron_venta.search(ventana) or patron_venta.search(html)
+    if not m_c or not m_v:
+        return None
+    return _parsear_monto(m_c.group(1)), _parsear_monto(m_v.group(1))
+
+
+def _extraer_compra_venta_streaming(contenido: bytes) -> Optional[Tuple[float, float]]:
+    extractor = _ExtractorDolarhoy()
+    for i in range(0, len(contenido), cfg.HTTP_CHUNK_BYTES):
+        if extractor.alimentar(contenido[i:i + cfg.HTTP_CHUNK_BYTES]):
+            break
+    return extractor.resultado()
+
+
+def bench_parser(rutas: List[str], repeticiones: int) -> int:
+    """Microbenchmark de los parsers de Dolarhoy contra páginas guardadas."""
+    if not rutas:
+        print("Pasá una o más páginas de Dolarhoy guardadas (p. ej. logs/dolarhoy_debug.html).")
+        return 1
+
+    parsers = (
+        ("legacy", _extraer_compra_venta_legacy),
+        ("bytes", _extraer_compra_venta),
+        ("streaming", _extraer_compra_venta_streaming),
+    )
+    for ruta in rutas:
+        with open(ruta, "rb") as f:
+            contenido = f.read()
+        print(f"{ruta} ({len(contenido)} bytes)")
+        for nombre, parser in parsers:
+            tiempos = timeit.repeat(lambda: parser(contenido), number=repeticiones, repeat=5)
+            print(f"  {nombre:<10} {min(tiempos) / repeticiones * 1e6:10.1f} µs/parse  -> {parser(contenido)}")
+    return 0
+
+
+def _anuncio_binance_sintetico(i: int) -> Dict[str, Any]:
+    """Un item con la forma (y el tamaño aproximado) de los que devuelve adv/search."""
+    precio = 1400 + i * 0.05
+    return {
+        "adv": {
+            "advNo": f"1172{i:015d}", "classify": "mass", "tradeType": "SELL", "asset": "USDT",
+            "fiatUnit": "ARS", "advStatus": None, "priceType": None, "priceFloatingRatio": None,
+            "rateFloatingRatio": None, "currencyRate": None, "price": f"{precio:.2f}",
+            "initAmount": None, "surplusAmount": "1523.40", "amountAfterEditing": None,
+            "maxSingleTransAmount": "2500000.00", "minSingleTransAmount": "20000.00",
+            "buyerKycLimit": None, "buyerRegDaysLimit": None, "buyerBtcPositionLimit": None,
+            "remarks": None, "autoReplyMsg": "", "payTimeLimit": None,
+            "tradeMethods": [{
+                "payId": None, "payMethodId": "", "payType": None, "payAccount": None,
+                "payBank": None, "paySubBank": None, "identifier": "BANK",
+                "iconUrlColor": None, "tradeMethodName": "Transferencia bancaria",
+                "tradeMethodShortName": "Banco", "tradeMethodBgColor": "#F0B90B",
+            }],
+            "userTradeCountFilterTime": None, "userBuyTradeCountMin": None, "userBuyTradeCountMax": None,
+            "userSellTradeCountMin": None, "userSellTradeCountMax": None, "userAllTradeCountMin": None,
+            "userAllTradeCountMax": None, "userTradeCompleteRateFilterTime": None,
+            "userTradeCompleteCountMin": None, "userTradeCompleteRateMin": None,
+            "userTradeVolumeFilterTime": None, "userTradeType": None, "userTradeVolumeMin": None,
+            "userTradeVolumeMax": None, "userTradeVolumeAsset": None, "createTime": None,
+            "advUpdateTime": None, "fiatVo": None, "assetVo": None, "advVisibleRet": None,
+            "assetLogo": None, "assetScale": 2, "fiatScale": 2, "priceScale": 2, "fiatSymbol": "ARS$",
+            "isTradable": True, "dynamicMaxSingleTransAmount": "2500000.00",
+            "minSingleTransQuantity": "13.94", "maxSingleTransQuantity": "1523.40",
+            "dynamicMaxSingleTransQuantity": "1523.40", "tradableQuantity": "1523.40",
+            "commissionRate": "0.00100000", "takerCommissionRate": None,
+            "tradeMethodCommissionRates": [], "launchCountry": None, "abnormalStatusList": None,
+            "closeReason": None, "storeInformation": None, "allowTradeMerchant": None,
+        },
+        "advertiser": {
+            "userNo": f"s{i:031x}", "realName": None, "nickName": f"vendedor_{i}",
+            "margin": None, "marginUnit": None, "orderCount": None, "monthOrderCount": 1200 + i,
+            "monthFinishRate": 0.98, "positiveRate": 0.99, "advConfirmTime": None, "email": None,
+            "registrationTime": None, "mobile": None, "userType": "merchant", "tagIconUrls": [],
+            "userGrade": 2, "userIdentity": "MASS_MERCHANT", "proMerchant": None,
+            "badges": None, "isBlocked": None, "activeTimeInSecond": -1,
+        },
+    }
+
+
+def bench_memoria(n: int) -> int:
+    """Memoria retenida por anuncio: dicts anidados de json.loads vs AnuncioP2P con slots."""
+    crudo = json.dumps({"code": "000000", "data": [_anuncio_binance_sintetico(i) for i in range(n)]})
+    crudo_bytes = crudo.encode("utf-8")
+
+    def medir(construir: Callable[[], Any]) -> Tuple[int, int]:
+        gc.collect()
+        tracemalloc.start()
+        obj = construir()
+        actual, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del obj
+        return actual, pico
+
+    formas = (
+        ("dicts (json.loads)", lambda: json.loads(crudo)["data"]),
+        ("AnuncioP2P (slots)", lambda: [AnuncioP2P.desde_json(item) for item in _leer_json(crudo_bytes)["data"]]),
+    )
+    print(f"{n} anuncios, {len(crudo)} bytes de JSON")
+    for nombre, construir in formas:
+        actual, pico = medir(construir)
+        print(f"  {nombre:<20} retenido={actual / n:8.0f} B/anuncio  pico={pico / 1e6:7.2f} MB")
+    return 0
+
+
+class _HandlerStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers y body salen en writes separados: sin esto, Nagle + delayed ACK suman ~40 ms por respuesta.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def responder(self, status: int, body: bytes, tipo: str = "text/plain; charset=utf-8") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stub.contar(len(body))
+
+    def do_GET(self) -> None:
+        self.server.stub.atender(self, b"")
+
+    def do_POST(self) -> None:
+        largo = int(self.headers.get("Content-Length") or 0)
+        self.server.stub.atender(self, self.rfile.read(largo))
+
+
+class _ServidorStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Conexiones que el cliente corta a mitad (hedge, streaming, keep-alive cerrado): no es un error del stub.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+# Los fixtures del repo son sintéticos: imitan la estructura de la página de Dolarhoy
+# y de la respuesta de Binance P2P, pero no son capturas. `bench --grabar` los
+# reemplaza por grabaciones reales.
+DIR_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class StubBench:
+    """
+    Servidor HTTP local que reproduce fixtures (sintéticos o grabados con `bench --grabar`):
+      GET  /dolarhoy/...  -> dolarhoy.html
+      POST /binance       -> binance_p2p_<page>.json (sin ofertas pasada la última página)
+      POST /form          -> ok
+    Cada respuesta espera latencia ± jitter y falla con 503 con probabilidad `fallas`.
+    Cuenta los bytes de body en ambos sentidos.
+    """
+
+    def __init__(self, fixtures: str, latencia: float, jitter: float, fallas: float, semilla: int = 0):
+        with open(os.path.join(fixtures, "dolarhoy.html"), "rb") as f:
+            self.dolarhoy = f.read()
+        self.paginas_binance: List[bytes] = []
+        while os.path.exists(ruta := os.path.join(fixtures, f"binance_p2p_{len(self.paginas_binance) + 1}.json")):
+            with open(ruta, "rb") as f:
+                self.paginas_binance.append(f.read())
+        if not self.paginas_binance:
+            raise FileNotFoundError(f"No hay fixtures de Binance (binance_p2p_1.json) en {fixtures}")
+
+        self.latencia = latencia
+        self.jitter = jitter
+        self.fallas = fallas
+        self._azar = random.Random(semilla)
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+        self._servidor = _ServidorStub(("127.0.0.1", 0), _HandlerStub)
+        self._servidor.stub = self
+        threading.Thread(target=self._servidor.serve_forever, name="stub-bench", daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._servidor.server_address[1]}"
+
+    def contar(self, n: int) -> None:
+        with self._lock:
+            self.bytes += n
+
+    def atender(self, handler: _HandlerStub, body: bytes) -> None:
+        self.contar(len(body))
+        with self._lock:
+            demora = max(0.0, self.latencia + self._azar.uniform(-self.jitter, self.jitter))
+            falla = self._azar.random() < self.fallas
+        time.sleep(demora)
+        if falla:
+            handler.responder(503, b"stub: falla inyectada")
+            return
+
+        ruta = urlsplit(handler.path).path
+        if handler.command == "GET" and ruta.startswith("/dolarhoy"):
+            handler.responder(200, self.dolarhoy, "text/html; charset=utf-8")
+        elif handler.command == "POST" and ruta == "/binance":
+            page = json.loads(body or b"{}").get("page", 1)
+            pagina = self.paginas_binance[page - 1] if 1 <= page <= len(self.paginas_binance) else b'{"code":"000000","data":[]}'
+            handler.responder(200, pagina, "application/json")
+        elif handler.command == "POST" and ruta == "/form":
+            handler.responder(200, b"ok")
+        else:
+            handler.responder(404, b"stub: ruta desconocida")
+
+    def cerrar(self) -> None:
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+
+def _percentil(valores: List[float], q: float) -> float:
+    """Percentil con interpolación lineal (como numpy.percentile por default)."""
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * q / 100
+    i = int(k)
+    if i + 1 >= len(ordenados):
+        return ordenados[-1]
+    return ordenados[i] + (ordenados[i + 1] - ordenados[i]) * (k - i)
+
+
+def _formatear_percentiles(valores: List[float], escala: float = 1e3, unidad: str = "ms") -> str:
+    return " ".join(f"p{q}={_percentil(valores, q) * escala:8.1f}{unidad}" for q in (50, 95, 99))
+
+
+def grabar_fixtures(fixtures: str) -> int:
+    """Baja la página de Dolarhoy y BINANCE_PAGES páginas de Binance tal cual, para el bench."""
+    logger = configurar_logger()
+    session = crear_sesion()
+    os.makedirs(fixtures, exist_ok=True)
+
+    r = request_seguro("GET", cfg.DOLARHOY_URLS[0], logger, session)
+    with open(os.path.join(fixtures, "dolarhoy.html"), "wb") as f:
+        f.write(r.content)
+
+    par = _par_configurado()
+    for page in range(1, max(cfg.BINANCE_PAGES, 1) + 1):
+        r = request_seguro("POST", cfg.BINANCE_P2P_API_URL, logger, session, json=_payload_binance(page, par))
+        with open(os.path.join(fixtures, f"binance_p2p_{page}.json"), "wb") as f:
+            f.write(r.content)
+
+    session.close()
+    logger.info("Fixtures grabados en %s/", fixtures)
+    return 0
+
+
+def main_bench(
+    fixtures: str,
+    iteraciones: int,
+    calentamiento: int,
+    latencia_ms: float,
+    jitter_ms: float,
+    fallas: float,
+    muestras_memoria: int,
+    semilla: int,
+) -> int:
+    """
+    Corre el pipeline de main() contra el stub local: latencia end-to-end (p50/p95/p99),
+    tiempo por etapa, bytes por ciclo y memoria (tracemalloc, en pasadas aparte para no
+    inflar los tiempos). Sin caches ni historial, así cada ciclo va a la "red".
+    """
+    global cfg, FORM_URL
+    stub = StubBench(fixtures, latencia_ms / 1e3, jitter_ms / 1e3, fallas, semilla)
+    # Estado propio: el outbox real no se toca (si no, el publicador mandaría las filas
+    # pendientes de producción al /form del stub y las marcaría como enviadas).
+    directorio = tempfile.mkdtemp(prefix="bench-")
+    cfg_original, form_original = cfg, FORM_URL
+    cfg = replace(
+        cfg,
+        STATE_DIR=directorio,
+        DOLARHOY_URLS=(f"{stub.url}/dolarhoy/cotizacion-dolar-blue", f"{stub.url}/dolarhoy/cotizaciondolarblue"),
+        BINANCE_P2P_API_URL=f"{stub.url}/binance",
+        DOLARHOY_CONDITIONAL_GET=False,
+        CACHE_TTL_DOLARHOY_SECS=0.0,
+        CACHE_TTL_BINANCE_SECS=0.0,
+        HISTORY_ENABLED=False,
+        METRICS_NDJSON="",
+        # Con --fallas el breaker cortaría al stub y los timeouts adaptativos cambiarían
+        # entre iteraciones: se mide el pipeline con los reintentos tal cual.
+        CIRCUIT_BREAKER=False,
+        HTTP_ADAPTIVE_TIMEOUT=False,
+        # Se mide el pipeline, no el ritmo permitido por host.
+        RATE_LIMIT=False,
+    )
+    FORM_URL = f"{stub.url}/form"
+
+    logger = logging.getLogger("cotizations-bot.bench")
+    logger.handlers = [logging.NullHandler()]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    session = crear_sesion()
+
+    def ciclo() -> Tuple[int, float, Dict[str, float], int]:
+        tiempos: Dict[str, float] = {}
+        bytes_antes = stub.bytes
+        t0 = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()):
+                rc = ejecutar_ciclo(logger, session, tiempos)
+        except Exception:
+            rc = 1
+        return rc, time.perf_counter() - t0, tiempos, stub.bytes - bytes_antes
+
+    try:
+        for _ in range(calentamiento):
+            ciclo()
+
+        totales: List[float] = []
+        por_etapa: Dict[str, List[float]] = {}
+        bytes_por_ciclo: List[float] = []
+        ok = 0
+        for _ in range(iteraciones):
+            rc, total, tiempos, transferidos = ciclo()
+            ok += rc == 0
+            totales.append(total)
+            bytes_por_ciclo.append(transferidos)
+            for etapa, segundos in tiempos.items():
+                por_etapa.setdefault(etapa, []).append(segundos)
+
+        picos: List[int] = []
+        netos: List[int] = []
+        for _ in range(muestras_memoria):
+            gc.collect()
+            tracemalloc.start()
+            ciclo()
+            actual, pico = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            picos.append(pico)
+            netos.append(actual)
+    finally:
+        cerrar_publicador()
+        session.close()
+        cerrar_async()
+        stub.cerrar()
+        cfg, FORM_URL = cfg_original, form_original
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    print(
+        f"bench: {iteraciones} ciclos (+{calentamiento} de calentamiento) | latencia={latencia_ms:g}ms "
+        f"jitter={jitter_ms:g}ms fallas={fallas:.0%} | fixtures={fixtures} | async={'httpx' if httpx is not None else 'requests'}"
+    )
+    if not totales:
+        return 1
+    print(f"  {'end-to-end':<18} {_formatear_percentiles(totales)}  ok={ok}/{iteraciones}")
+    for etapa, valores in por_etapa.items():
+        print(f"  {etapa:<18} {_formatear_percentiles(valores)}")
+    print(f"  {'bytes/ciclo':<18} {_formatear_percentiles(bytes_por_ciclo, 1 / 1024, 'KB')}")
+    if picos:
+        print(
+            f"  {'memoria/ciclo':<18} pico={max(picos) / 1024:.0f}KB (mediana {_percentil(picos, 50) / 1024:.0f}KB) "
+            f"neto={_percentil(netos, 50) / 1024:.0f}KB  [{len(picos)} ciclos con tracemalloc]"
+        )
+    return 0 if ok else 1
+
+
+def bench_outbox(filas: int, latencia_ms: float, concurrencia: int) -> int:
+    """Throughput de replay del outbox: `filas` pendientes contra el /form del stub local."""
+    global cfg, FORM_URL
+    directorio = tempfile.mkdtemp(prefix="bench-outbox-")
+    stub = StubBench(DIR_FIXTURES, latencia_ms / 1e3, 0.0, 0.0)
+    cfg_original, form_original = cfg, FORM_URL
+    # Sin rate limit: se mide cuánto da el replay, no el ritmo permitido por host.
+    cfg = replace(cfg, STATE_DIR=directorio, FORM_REPLAY_CONCURRENCY=concurrencia, METRICS_NDJSON="", RATE_LIMIT=False)
+    FORM_URL = f"{stub.url}/form"
+
+    logger = logging.getLogger("cotizations-bot.bench")
+    logger.handlers = [logging.NullHandler()]
+    logger.propagate = False
+    try:
+        outbox = OutboxForm(_ruta_estado("outbox_form.sqlite3"))
+        outbox.agregar_muchas([(f"bench-{i}", {"cotizacion_final": str(1200 + i % 50)}) for i in range(filas)])
+        t0 = time.perf_counter()
+        PublicadorForm(logger, outbox).cerrar()
+        duracion = time.perf_counter() - t0
+        pendientes = outbox.pendientes()
+    finally:
+        stub.cerrar()
+        cfg, FORM_URL = cfg_original, form_original
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    print(
+        f"outbox: {filas} filas, latencia={latencia_ms:g}ms, concurrencia={concurrencia} -> "
+        f"{duracion:.2f}s ({(filas - pendientes) / duracion:.0f} filas/s), pendientes={pendientes}"
+    )
+    return 0 if not pendientes else 1
+
+
+def bench_logging(n: int) -> int:
+    """
+    Costo por llamada (en el thread que loguea) de la línea de debug de request_seguro:
+    f-string vs %-args, con DEBUG apagado (nivel INFO) y prendido, y QueueHandler
+    estándar (formatea al encolar) vs el diferido.
+    """
+    method, url, intento = "POST", "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search", 2
+    logger = logging.getLogger("cotizations-bot.bench-logging")
+    logger.propagate = False
+
+    variantes = (
+        ("f-string", lambda: logger.debug(f"HTTP {method} intento {intento}/{cfg.HTTP_RETRIES}: {url}")),
+        ("%-args", lambda: logger.debug("HTTP %s intento %d/%d: %s", method, intento, cfg.HTTP_RETRIES, url)),
+        ("%-args+kv", lambda: logger.debug(
+            "HTTP %s intento %d/%d: %s", method, intento, cfg.HTTP_RETRIES, url,
+            extra=kv(metodo=method, url=url, intento=intento),
+        )),
+    )
+    print(f"{n} llamadas por variante (ns/llamada, sólo el lado que loguea)")
+    for nombre_handler, clase in (("QueueHandler", logging.handlers.QueueHandler), ("diferido", _QueueHandlerDiferido)):
+        for nivel in (logging.INFO, logging.DEBUG):
+            cola: queue.SimpleQueue = queue.SimpleQueue()
+            handler = clase(cola)
+            handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+            logger.handlers = [handler]
+            logger.setLevel(nivel)
+            fila = []
+            for nombre, llamada in variantes:
+                mejor = min(timeit.repeat(llamada, number=n, repeat=3)) / n
+                fila.append(f"{nombre}={mejor * 1e9:7.0f}")
+                while not cola.empty():
+                    cola.get_nowait()
+            print(f"  {nombre_handler:<12} nivel={logging.getLevelName(nivel):<5} " + "  ".join(fila))
+    return 0
+
+
+def _parsear_argumentos(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Cotizations bot (Dólar Blue + Binance P2P).")
+    sub = parser.add_subparsers(dest="comando")
+    sub.add_parser("run", help="Corrida normal (default).")
+    sub.add_parser("lote", help="Cotiza la matriz BATCH_ASSETS x BATCH_FIATS x BATCH_TRADE_TYPES.")
+    p_hist = sub.add_parser("historial", help="Consulta el historial local de cotizaciones.")
+    p_hist.add_argument("--desde", help="Fecha/hora ISO (local), inclusive.")
+    p_hist.add_argument("--hasta", help="Fecha/hora ISO (local), exclusive.")
+    p_hist.add_argument("--ultimo", action="store_true", help="Sólo el último registro.")
+    p_serve = sub.add_parser("serve", help="Daemon: corre un ciclo en cada disparo del cron (SERVE_CRON).")
+    p_serve.add_argument("--cron", default=None, help="Expresión cron de 5 campos (hora local).")
+    p_serve.add_argument("--metricas-puerto", type=int, default=None, help="Puerto de GET /metrics (0 = apagado).")
+    p_parser = sub.add_parser("bench-parser", help="Microbenchmark del parser de Dolarhoy sobre páginas guardadas.")
+    p_parser.add_argument("paginas", nargs="*")
+    p_parser.add_argument("-n", "--repeticiones", type=int, default=200)
+    p_mem = sub.add_parser("bench-memoria", help="Memoria por anuncio: dicts de Binance vs AnuncioP2P.")
+    p_mem.add_argument("-n", "--anuncios", type=int, default=10000)
+    p_outbox = sub.add_parser("bench-outbox", help="Throughput de replay del outbox del Google Form contra el stub local.")
+    p_outbox.add_argument("-n", "--filas", type=int, default=2000)
+    p_outbox.add_argument("--latencia-ms", type=float, default=50.0)
+    p_outbox.add_argument("--concurrencia", type=int, default=cfg.FORM_REPLAY_CONCURRENCY)
+    p_log = sub.add_parser("bench-logging", help="Costo por llamada de logging: f-string vs %%-args, por nivel.")
+    p_log.add_argument("-n", "--llamadas", type=int, default=100000)
+    p_bench = sub.add_parser("bench", help="Pipeline completo contra un stub local que reproduce fixtures.")
+    p_bench.add_argument("--fixtures", default=DIR_FIXTURES, help="Directorio de fixtures (los del repo son sintéticos).")
+    p_bench.add_argument("-n", "--iteraciones", type=int, default=30)
+    p_bench.add_argument("--calentamiento", type=int, default=2)
+    p_bench.add_argument("--latencia-ms", type=float, default=50.0)
+    p_bench.add_argument("--jitter-ms", type=float, default=20.0)
+    p_bench.add_argument("--fallas", type=float, default=0.0, help="Probabilidad de 503 por request (0-1).")
+    p_bench.add_argument("--memoria", type=int, default=3, help="Ciclos extra medidos con tracemalloc.")
+    p_bench.add_argument("--semilla", type=int, default=0)
+    p_bench.add_argument("--grabar", action="store_true", help="Graba los fixtures desde los sitios reales y sale.")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = _parsear_argumentos(sys.argv[1:])
+    if args.comando == "lote":
+        raise SystemExit(main_lote())
+    if args.comando == "historial":
+        raise SystemExit(main_historial(args.desde, args.hasta, args.ultimo))
+    if args.comando == "serve":
+        puerto = cfg.METRICS_PORT if args.metricas_puerto is None else args.metricas_puerto
+        raise SystemExit(main_serve(args.cron or cfg.SERVE_CRON, puerto))
+    if args.comando == "bench":
+        if args.grabar:
+            raise SystemExit(grabar_fixtures(args.fixtures))
+        raise SystemExit(main_bench(
+            args.fixtures, args.iteraciones, args.calentamiento, args.latencia_ms,
+            args.jitter_ms, args.fallas, args.memoria, args.semilla,
+        ))
+    if args.comando == "bench-outbox":
+        raise SystemExit(bench_outbox(args.filas, args.latencia_ms, args.concurrencia))
+    if args.comando == "bench-logging":
+        raise SystemExit(bench_logging(args.llamadas))
+    if args.comando == "bench-memoria":
+        raise SystemExit(bench_memoria(args.anuncios))
+    if args.comando == "bench-parser":
+        raise SystemExit(bench_parser(args.paginas, args.repeticiones))
     raise SystemExit(main())